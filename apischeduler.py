@@ -0,0 +1,276 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Scheduling of API requests within a request budget.
+
+APIScheduler hands out requests from a token bucket, so that however
+many workers share it they stay within one request rate.  When the API
+reports that the database is lagged, that we are rate limited, or the
+request times out, all workers pause, the rate is halved and the
+request is retried.  The pause doubles with each retry, and is never
+shorter than what the server asks for, either in a Retry-After header
+or as the lag in a maxlag error.  The rate then creeps back up with
+each success, staying close to what the server allows.
+
+pywikibot already waits out maxlag errors whose lag it can parse,
+pausing only the thread that made the request; the scheduler handles
+those it gives up on or cannot parse.
+
+Use ScheduledSite to route a site's requests through a scheduler, see
+revisions.api_request().
+'''
+
+import re
+import time
+import logging
+import threading
+import email.utils
+
+# Lag reported in maxlag errors, e.g. "Waiting for 10.64.0.1: 6 seconds lagged"
+lag_re = re.compile(r'(\d+(?:\.\d+)?) seconds? lagged')
+
+def maxlag(error):
+    '''
+    Get the lag in seconds reported by a maxlag error, or None if the
+    error is not one or its lag cannot be parsed.
+
+    @param error: the exception raised by the request
+    @type error: Exception
+    '''
+
+    if getattr(error, 'code', None) != 'maxlag':
+        return None
+    lag = lag_re.search(getattr(error, 'info', None) or u'')
+    if lag:
+        return float(lag.group(1))
+    return None
+
+def retry_after(error):
+    '''
+    Get the number of seconds the server asked us to wait in the
+    Retry-After header of a failed request, or None if it did not.
+    The header is looked for in the extra information of API errors
+    and in the response of HTTP errors.
+
+    @param error: the exception raised by the request
+    @type error: Exception
+    '''
+
+    value = None
+    other = getattr(error, 'other', None) or {}
+    for key in ('retry-after', 'retry_after', 'Retry-After'):
+        if key in other:
+            value = other[key]
+            break
+    else:
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if headers:
+            value = headers.get('Retry-After')
+
+    if value is None:
+        return None
+
+    # either a number of seconds or an HTTP date
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    date = email.utils.parsedate_tz(str(value))
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+class APIScheduler:
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, backoff=5.0,
+                 max_retries=5):
+        '''
+        Instantiate a scheduler.
+
+        @param rate: maximum number of requests per second
+        @type rate: float
+
+        @param burst: number of requests that can be made at once
+                      after a quiet period
+        @type burst: int
+
+        @param min_rate: the rate is never lowered below this
+        @type min_rate: float
+
+        @param backoff: seconds to pause after the first failure when the
+                        server does not say how long to wait, doubled
+                        with each retry
+        @type backoff: float
+
+        @param max_retries: number of times to retry a request
+        @type max_retries: int
+        '''
+
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.max_retries = max_retries
+
+        # Tokens in the bucket, when it was last filled, and
+        # until when all requests are paused
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0.0
+
+        # Guards the bucket, shared by all workers
+        self.lock = threading.Lock()
+
+        # Largest lag reported in maxlag errors since lag_since() last
+        # read it, and when it was reported
+        self.lag = None
+        self.lag_time = 0.0
+
+        # Number of requests made and throttled, and seconds spent waiting
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        '''
+        Wait until a request can be made.
+        '''
+
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens
+                                      + max(0.0, now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.n_requests += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def succeeded(self):
+        '''
+        Record a successful request, raising the rate a little.
+        '''
+
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0)
+
+    def throttled(self, delay):
+        '''
+        Pause all requests for the given time and halve the rate.
+
+        @param delay: seconds to pause
+        @type delay: float
+        '''
+
+        with self.lock:
+            self.n_throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+    def lag_since(self, start):
+        '''
+        Get the largest lag in seconds reported by maxlag errors since
+        the given time, or None if there were none.
+
+        @param start: time to look from, as from time.time()
+        @type start: float
+        '''
+
+        with self.lock:
+            if self.lag_time < start:
+                return None
+            lag = self.lag
+            self.lag = None
+            return lag
+
+    def retry_delay(self, error, attempt):
+        '''
+        Get how long to pause before retrying a failed request, or None
+        if the request should not be retried.  The backoff doubles with
+        each retry, and is raised to what the server asked for if that
+        is longer.
+
+        @param error: the exception raised by the request
+        @type error: Exception
+
+        @param attempt: number of times the request has been retried
+        @type attempt: int
+        '''
+
+        from pywikibot.data import api
+
+        # requests the server told us to retry later always are
+        minimum = retry_after(error)
+        if isinstance(error, api.APIError):
+            if error.code == 'maxlag':
+                minimum = max(minimum, maxlag(error))
+            elif (minimum is None
+                  and not error.code in ('ratelimited', 'readonly')):
+                return None
+        elif minimum is None and not isinstance(error, api.TimeoutError):
+            return None
+        return max(minimum, self.backoff * 2 ** attempt)
+
+    def request(self, site, params):
+        '''
+        Make an API request within the budget, retrying it if the server
+        asks us to back off.
+
+        @param site: site we're querying
+        @type site: pywikibot.Site
+
+        @param params: request parameters
+        @type params: dict
+        '''
+
+        import revisions
+
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                data = revisions.api_request(site, params)
+            except Exception, e:
+                lag = maxlag(e)
+                if lag is not None:
+                    with self.lock:
+                        self.lag = max(self.lag, lag)
+                        self.lag_time = time.time()
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                logging.warning(u"API request failed ({0}), pausing requests for {1:.1f}s".format(e, delay))
+                self.throttled(delay)
+                attempt += 1
+            else:
+                self.succeeded()
+                return data
+
+class ScheduledSite:
+    '''
+    Wraps a pywikibot site (or a recording site), making its API
+    requests through a scheduler.
+    '''
+
+    def __init__(self, site, scheduler):
+        self.site = site
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.site, name)
+
+    def api_request(self, params):
+        return self.scheduler.request(self.site, params)
+
+# Scheduler shared by all workers unless they are given their own
+api_scheduler = APIScheduler()
@@ -2,13 +2,36 @@
 # -*- coding: utf-8 -*-
 '''
 Class for article assessments.
+
+Talk page revisions are parsed by the million, so assessments are kept
+small: they have slots rather than a per-instance dict, their rating
+strings are shared, and the rating is mapped to its rank on the WP 1.0
+scale once, when the assessment is made.
 '''
 
-class Assessment:
+# Ranks of the assessment classes on the WP 1.0 scale
+wp10_scale = {'stub': 0,
+              'start': 1,
+              'c': 2,
+              'b': 3,
+              'ga': 4,
+              'a': 5,
+              'fa': 6}
+
+# One copy of each rating string seen, see Assessment
+_ratings = {}
+
+class Assessment(object):
+    # object for __slots__, which old-style classes ignore
+    __slots__ = ('rating', 'importance', 'project', 'rank')
+
     def __init__(self, rating, importance=None, project=None):
-        self.rating = rating
+        self.rating = _ratings.setdefault(rating, rating)
         self.importance = importance
         self.project = project
 
+        # Rank on the WP 1.0 scale, None if not a valid assessment class
+        self.rank = wp10_scale.get(rating)
+
     def __str__(self):
         return u'Project: {0}, Class: {1}, Importance: {2}'.format(self.project, self.rating, self.importance)
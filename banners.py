@@ -0,0 +1,337 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Extraction of WikiProject assessments from talk page wikitext.
+
+Parsing every talk page revision with mwparserfromhell is expensive,
+while nearly all of them hold a few flat banner templates like
+"{{WikiProject Biology|class=B|importance=low}}".  get_assessments()
+therefore first scans the text with a regular expression, which finds
+such templates and reads their parameters directly.  If the text holds
+markup the scanner can't be certain about (nested templates, links or
+tags inside templates, comments, nowiki and similar sections, stray
+braces) it falls back to parsing the text with mwparserfromhell.  Both
+paths give the same results.
+
+Banners usually sit at the top of a talk page, above the discussions,
+so banner_region() finds the part of a revision worth looking at.
+
+AssessmentPool spreads the parsing over several processes, so that it
+is not held to a single core.
+
+Assessments are (project, rating, importance) tuples, where project is
+the lowercased template name.
+'''
+
+import re
+
+# Templates without braces inside them, that are not part of
+# triple-brace template parameters
+template_re = re.compile(ur'(?<!\{)\{\{([^{}]*)\}\}(?!\})')
+
+# Markup that changes what the parser sees as templates: comments,
+# sections it does not parse (mwparserfromhell's PARSER_BLACKLIST),
+# and NUL characters, which it does not accept
+verbatim_re = re.compile(ur'\x00|<!--|<\s*(?:categorytree|gallery|hiero|imagemap|inputbox|math|nowiki|pre|score|section|source|syntaxhighlight|templatedata|timeline)\b', re.I)
+
+# Characters that make a template more than name and parameters
+markup_re = re.compile(ur'[\[\]<>]')
+
+# Leftover braces after the templates are taken out
+brace_re = re.compile(ur'\{\{|\}\}')
+
+banner_re = re.compile(ur'wikiproject\s+', re.I)
+
+# Template braces and section headings, for finding the banner region
+region_re = re.compile(ur'\{\{|\}\}|^=+[^\n]*=[ \t]*$', re.M)
+
+# Names of templates, and class parameters, for finding banners
+# in the banner region
+template_name_re = re.compile(ur'\{\{\s*([^{}|]*)')
+class_param_re = re.compile(ur'\|\s*class\s*=')
+
+def is_banner(name, translations):
+    '''
+    Is a template with the given name a WikiProject banner?
+    '''
+    return banner_re.match(name) or name in translations
+
+def holds_banner(template, translations):
+    '''
+    Is the given template, or one nested in it, a WikiProject banner
+    or an assessment?
+    '''
+
+    if class_param_re.search(template):
+        return True
+    for match in template_name_re.finditer(template):
+        name = match.group(1).strip()
+        if is_banner(name, translations) or name.lower() in translations:
+            return True
+    return False
+
+def banner_region(text, limit=8*1024, translations={}):
+    '''
+    Get the start of the given wikitext that holds its banners: up to
+    the first section heading outside a template, if there are banners
+    above it, and at most the first limit characters, unless that would
+    cut a template in half.  Pages that start with a section, e.g. one
+    left over from before they were tagged, have their banners further
+    down, so for those the first limit characters are looked at.
+
+    @param text: wikitext of a talk page revision
+    @type text: unicode
+
+    @param limit: number of characters to look at when the page has
+                  no sections, or only late ones
+    @type limit: int
+
+    @param translations: names of templates that are assessments
+                         without being named "WikiProject ..."
+    @type translations: dict
+    '''
+
+    depth = 0
+    start = 0
+    # Have we seen a banner, and are we still above the first heading?
+    banners = False
+    at_top = True
+    for match in region_re.finditer(text):
+        token = match.group()
+        if depth == 0 and match.start() >= limit:
+            return text[:limit]
+        if token == u'{{':
+            if depth == 0:
+                start = match.start()
+            depth += 1
+        elif token == u'}}':
+            if depth > 0:
+                depth -= 1
+                if depth == 0:
+                    if at_top and not banners:
+                        banners = holds_banner(text[start:match.end()],
+                                               translations)
+                    if match.end() > limit:
+                        return text[:match.end()] # end of the template
+        elif depth == 0 and at_top:
+            if banners:
+                return text[:match.start()] # section heading
+            at_top = False
+
+    return text[:limit]
+
+def scan_assessments(text, translations={}):
+    '''
+    Get the assessments in the given wikitext using the regex scanner,
+    or None if the text needs parsing.
+
+    @param text: wikitext of a talk page revision
+    @type text: unicode
+
+    @param translations: names of templates that are assessments
+                         without being named "WikiProject ..."
+    @type translations: dict
+    '''
+
+    if verbatim_re.search(text):
+        return None
+
+    assessments = []
+    pos = 0
+    for match in template_re.finditer(text):
+        if brace_re.search(text, pos, match.start()):
+            return None
+        pos = match.end()
+
+        body = match.group(1)
+        if markup_re.search(body):
+            return None
+
+        parts = body.split(u'|')
+        name = parts[0]
+        if not name.strip() or u'\n' in name.strip():
+            return None # not something we're certain is a template
+
+        # Named parameters, the last one wins, like the parser's get()
+        params = {}
+        for part in parts[1:]:
+            if u'=' in part:
+                (key, value) = part.split(u'=', 1)
+                params[key.strip()] = value
+
+        # Banners without a class, and other templates without
+        # one, are not assessments
+        if not u'class' in params:
+            continue
+
+        importance = params.get(u'importance')
+        if importance is not None:
+            importance = importance.strip().lower()
+        assessments.append((name.lower(),
+                            params[u'class'].strip().lower(),
+                            importance))
+
+    if brace_re.search(text, pos):
+        return None
+
+    return assessments
+
+def parse_assessments(text, translations={}):
+    '''
+    Get the assessments in the given wikitext by parsing it with
+    mwparserfromhell.
+
+    @param text: wikitext of a talk page revision
+    @type text: unicode
+
+    @param translations: names of templates that are assessments
+                         without being named "WikiProject ..."
+    @type translations: dict
+    '''
+
+    import mwparserfromhell as mwp
+
+    parsed_code = mwp.parse(text)
+    templates = parsed_code.filter_templates()
+    assessments = []
+    for temp in templates:
+        if is_banner(unicode(temp.name), translations) \
+                or temp.has_param('class'):
+            project = unicode(temp.name).lower()
+            try:
+                rating = unicode(temp.get('class').value).strip().lower()
+            except ValueError:
+                continue # no assessment class in template
+            importance = None
+            if temp.has_param('importance'):
+                importance = unicode(temp.get('importance').value).strip().lower()
+            assessments.append((project, rating, importance))
+    return assessments
+
+def get_assessments(text, translations={}):
+    '''
+    Get the assessments in the given wikitext, scanning it if possible
+    and parsing it if not.
+
+    @param text: wikitext of a talk page revision
+    @type text: unicode
+
+    @param translations: names of templates that are assessments
+                         without being named "WikiProject ..."
+    @type translations: dict
+    '''
+
+    assessments = scan_assessments(text, translations)
+    if assessments is None:
+        assessments = parse_assessments(text, translations)
+    return assessments
+
+# Template translations in pool worker processes, see AssessmentPool
+_worker_translations = {}
+
+def _init_worker(translations):
+    global _worker_translations
+    _worker_translations = translations
+
+def _parse_text(text):
+    return parse_assessments(text, _worker_translations)
+
+class AssessmentPool:
+    def __init__(self, processes=None, translations={}, scan=True,
+                 chunksize=32, min_parallel=8):
+        '''
+        Start a pool of processes for parsing revisions.
+
+        Texts are scanned in the calling process first, and only those
+        the scanner can't handle are sent to the pool, chunksize at a
+        time, so there is little to pickle and few messages.  The more
+        texts are given at once, e.g. those of many revision slices or
+        articles to imap(), the better the work is spread.
+
+        @param processes: number of worker processes, defaults to the
+                          number of CPUs
+        @type processes: int
+
+        @param translations: names of templates that are assessments
+                             without being named "WikiProject ..."
+        @type translations: dict
+
+        @param scan: scan texts before parsing them, turned off
+                     to benchmark the parser
+        @type scan: bool
+
+        @param chunksize: largest number of texts sent to a worker at once
+        @type chunksize: int
+
+        @param min_parallel: fewer texts to parse than this are parsed
+                             in the calling process, where they cost
+                             less than a round trip to the pool
+        @type min_parallel: int
+        '''
+
+        import multiprocessing
+
+        self.processes = processes or multiprocessing.cpu_count()
+        self.translations = translations
+        self.scan = scan
+        self.chunksize = chunksize
+        self.min_parallel = min_parallel
+        self.pool = multiprocessing.Pool(self.processes, _init_worker,
+                                         (translations,))
+
+        # Number of texts scanned, parsed, and parsed in the pool
+        self.n_scanned = 0
+        self.n_parsed = 0
+        self.n_pooled = 0
+
+    def imap(self, texts):
+        '''
+        Iterate over the assessments in each of the given texts,
+        in the same order.
+
+        @param texts: wikitext of talk page revisions
+        @type texts: iterable
+        '''
+
+        texts = list(texts)
+        results = [None] * len(texts)
+        if self.scan:
+            results = [scan_assessments(text, self.translations)
+                       for text in texts]
+        todo = [i for (i, result) in enumerate(results) if result is None]
+        self.n_scanned += len(texts) - len(todo)
+        self.n_parsed += len(todo)
+
+        if len(todo) < self.min_parallel:
+            for i in todo:
+                results[i] = parse_assessments(texts[i], self.translations)
+            todo = []
+        self.n_pooled += len(todo)
+
+        if todo:
+            # spread over the processes, in chunks of at most chunksize
+            chunksize = max(1, min(self.chunksize,
+                                   len(todo) // (4 * self.processes)))
+            parsed = self.pool.imap(_parse_text,
+                                    [texts[i] for i in todo], chunksize)
+
+        j = 0
+        for (i, result) in enumerate(results):
+            if j < len(todo) and todo[j] == i:
+                result = parsed.next()
+                j += 1
+            yield result
+
+    def get_assessments(self, texts):
+        '''
+        Get the assessments in each of the given texts.
+
+        @param texts: wikitext of talk page revisions
+        @type texts: list
+        '''
+
+        return list(self.imap(texts))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
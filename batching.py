@@ -0,0 +1,136 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Adaptive sizing of batched requests, such as the IN-lists of page IDs
+in the category traversal and the revision IDs in API requests.
+
+The best batch size depends on how expensive each query is and how
+busy the server is at the time, so rather than fixing it we measure
+the time per unit of work (item asked for or row returned) of each
+batch.  The batch grows while that improves, and shrinks when it gets
+worse, when a batch takes longer than we allow, when it fails, or when
+the server reports that it is lagging, e.g. the replica's lag from the
+heartbeat table (see db.ReplicaLag) or the lag in the API's maxlag
+errors (see apischeduler.APIScheduler.lag_since()).
+'''
+
+import logging
+import threading
+
+class AdaptiveSlice:
+    def __init__(self, size=100, minimum=10, maximum=1000,
+                 growth=2.0, tolerance=1.1, max_seconds=30.0, hold=8,
+                 max_lag=5.0):
+        '''
+        Instantiate a batch size controller.
+
+        @param size: initial batch size
+        @type size: int
+
+        @param minimum: smallest batch size
+        @type minimum: int
+
+        @param maximum: largest batch size
+        @type maximum: int
+
+        @param growth: factor by which the batch size grows or shrinks
+        @type growth: float
+
+        @param tolerance: how much worse than the best time per unit a
+                          batch can be before the batch size shrinks
+        @type tolerance: float
+
+        @param max_seconds: batches taking longer than this shrink
+                            the batch size regardless
+        @type max_seconds: float
+
+        @param hold: number of batches to wait after shrinking
+                     before trying to grow again
+        @type hold: int
+
+        @param max_lag: batches made while the server lags by more than
+                        this many seconds shrink the batch size
+        @type max_lag: float
+        '''
+
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.growth = growth
+        self.tolerance = tolerance
+        self.max_seconds = max_seconds
+        self.hold = hold
+        self.max_lag = max_lag
+
+        # Best time per unit of work since the size last shrank
+        self.best = None
+
+        # Number of batches left before we try to grow again
+        self.holding = 0
+
+        # Number of batches recorded, and of failed batches
+        self.n_batches = 0
+        self.n_failed = 0
+
+        # Guards the size so that workers can share a controller
+        self.lock = threading.Lock()
+
+    def record(self, n_items, n_rows, seconds, lag=None):
+        '''
+        Record how a batch went and adjust the batch size.
+
+        @param n_items: number of items in the batch
+        @type n_items: int
+
+        @param n_rows: number of rows (or revisions, etc) returned
+        @type n_rows: int
+
+        @param seconds: time taken by the batch
+        @type seconds: float
+
+        @param lag: seconds the server lagged by when the batch was made,
+                    None if we do not know
+        @type lag: float
+        '''
+
+        with self.lock:
+            self.n_batches += 1
+            cost = seconds / max(n_items, n_rows, 1)
+
+            if seconds > self.max_seconds:
+                self._resize(self.size / self.growth)
+            elif lag is not None and lag > self.max_lag:
+                logging.debug("Server lagging by {0}s".format(lag))
+                self._resize(self.size / self.growth)
+            elif n_items < self.size:
+                # A short (last) batch says nothing about the batch size,
+                # its fixed costs are spread over fewer items
+                pass
+            elif self.best is None or cost <= self.best * self.tolerance:
+                self.best = min(cost, self.best or cost)
+                # Grow, unless we shrank recently
+                if self.holding:
+                    self.holding -= 1
+                else:
+                    self._resize(self.size * self.growth, keep_best=True)
+            else:
+                self._resize(self.size / self.growth)
+
+    def failed(self):
+        '''
+        Record that a batch failed, e.g. timed out, and shrink the batch size.
+        '''
+
+        with self.lock:
+            self.n_batches += 1
+            self.n_failed += 1
+            self._resize(self.size / self.growth)
+
+    def _resize(self, size, keep_best=False):
+        size = max(self.minimum, min(self.maximum, int(size)))
+        if size != self.size:
+            logging.debug("Batch size {0} -> {1}".format(self.size, size))
+        self.size = size
+        if not keep_best:
+            self.best = None
+            self.holding = self.hold
@@ -0,0 +1,500 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for our scripts, run against local stand-ins rather than the
+live replica and API so that runs are repeatable.
+
+The "extract" benchmark runs getAssessmentClassArticles() and
+getArticles() from get-articles-by-assessment.py against a synthetic
+replica built by synthdb.py, and reports queries issued, rows
+transferred, wall time and peak memory for each run (the growth of the
+maximum resident set size where tracemalloc is not available).
+
+The "revisions" benchmark fetches talk page revisions with
+revisions.get_revisions() from the mock API in mockapi.py, and reports
+requests made, revisions fetched, errors injected and wall time.
+
+The "clean" benchmark runs the full cleaning pipeline of
+clean-training-set.py on a dataset, replaying database and API traffic
+recorded earlier with its --record option, so before/after throughput
+can be compared on identical workloads without the network.
+
+The "banners" benchmark extracts assessments from a corpus of talk
+page revisions with the regex scanner in banners.py and with
+mwparserfromhell, and checks that they agree.
+
+The "startup" benchmark times how long our scripts take to start, by
+running them with --help and, for clean-training-set.py, on an empty
+dataset.
+
+Results can be written as JSON to compare runs and catch regressions.
+'''
+
+import os
+import re
+import imp
+import sys
+import json
+import time
+import logging
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import synthdb
+import mockapi
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def load_script(filename):
+    '''
+    Import one of our hyphen-named scripts as a module.
+
+    @param filename: filename of the script, e.g. "sample-articles.py"
+    @type filename: str
+    '''
+
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    return imp.load_source(name, path)
+
+def measure(name, cursor, func, *args, **kwargs):
+    '''
+    Run the given function and measure it.  Returns a tuple of the
+    function's result and a dict of measurements.
+
+    Peak memory is measured with tracemalloc where it is available.
+    Otherwise, as on Python 2.7, only the growth of the process' maximum
+    resident set size is known, which misses a peak lower than that of
+    an earlier run in the same process, so benchmark one case at a time
+    (e.g. a single class with --classes) when comparing those.
+
+    @param name: name of the run, used in the report
+    @type name: str
+
+    @param cursor: counting database cursor used by the function, if any
+    @type cursor: synthdb.SQLiteCursor
+    '''
+
+    if cursor:
+        n_queries = cursor.n_queries
+        n_rows = cursor.n_rows
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+
+    result = func(*args, **kwargs)
+
+    elapsed = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    new_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stats = {'name': name,
+             'seconds': elapsed,
+             'peak_traced_bytes': peak,
+             'max_rss_kb': new_max_rss,
+             'max_rss_growth_kb': new_max_rss - max_rss}
+    if cursor:
+        stats['queries'] = cursor.n_queries - n_queries
+        stats['rows'] = cursor.n_rows - n_rows
+    return (result, stats)
+
+def report(results, json_filename=None):
+    '''
+    Print the measurements, and write them as JSON if a filename is given.
+
+    @param results: measurements from measure()
+    @type results: list
+
+    @param json_filename: path to the JSON output file
+    @type json_filename: str
+    '''
+
+    for stats in results:
+        line = u'{name}: {seconds:.3f}s'.format(**stats)
+        if stats['peak_traced_bytes'] is not None:
+            line += u', peak traced {peak_traced_bytes} bytes'.format(**stats)
+        line += u', max RSS {max_rss_kb} kB'.format(**stats)
+        if 'max_rss_growth_kb' in stats:
+            line += u' (grew {max_rss_growth_kb} kB)'.format(**stats)
+        print(line)
+        for key in sorted(stats):
+            if not key in ['name', 'seconds', 'peak_traced_bytes',
+                           'max_rss_kb', 'max_rss_growth_kb']:
+                print(u'  {0}: {1}'.format(key, stats[key]))
+
+    if json_filename:
+        with open(json_filename, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+def synthetic_db(args):
+    '''
+    Get the path to the synthetic replica, generating it if it
+    does not exist.
+    '''
+
+    dbfile = args.db
+    if not dbfile:
+        (fd, dbfile) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        os.remove(dbfile)
+
+    if not os.path.exists(dbfile):
+        # generated in a separate process, so that it does not raise
+        # our maximum resident set size before anything is measured
+        generator = multiprocessing.Process(
+            target=synthdb.generate, args=(dbfile,),
+            kwargs={'n_projects': args.projects,
+                    'depth': args.depth,
+                    'fanout': args.fanout,
+                    'n_articles': args.articles,
+                    'redirect_ratio': args.redirect_ratio,
+                    'seed': args.seed})
+        generator.start()
+        generator.join()
+        if generator.exitcode != 0:
+            raise RuntimeError('unable to generate the synthetic replica')
+    return dbfile
+
+def bench_extract(args):
+    '''
+    Benchmark the category extraction path.
+    '''
+
+    dbfile = synthetic_db(args)
+    script = load_script('get-articles-by-assessment.py')
+
+    sampler = script.ArticleSampler(outputFilename=os.devnull,
+                                    categoryCacheFile=args.category_cache)
+    (sampler.dbConn, sampler.dbCursor) = synthdb.connect(dbfile)
+
+    results = []
+    for assessment_class in args.classes.split(','):
+        (articles, stats) = measure(
+            'getAssessmentClassArticles({0})'.format(assessment_class),
+            sampler.dbCursor,
+            sampler.getAssessmentClassArticles,
+            assessmentClass=assessment_class)
+        stats['articles'] = len(articles)
+        results.append(stats)
+
+    (articles, stats) = measure('getArticles(FA-Class_Project0_articles)',
+                                sampler.dbCursor,
+                                sampler.getArticles,
+                                categoryName=u'FA-Class_Project0_articles',
+                                matchRegex=re.compile(u'FA-Class'))
+    stats['articles'] = len(articles)
+    results.append(stats)
+
+    sampler.dbCursor.close()
+    sampler.dbConn.close()
+    if not args.db:
+        os.remove(dbfile)
+
+    return results
+
+class FetchRevision:
+    '''
+    Revision to fetch, with the attributes get_revisions() expects.
+    '''
+    def __init__(self, id):
+        self.id = id
+        self.content = None
+
+def bench_revisions(args):
+    '''
+    Benchmark fetching revisions from the mock API.
+    '''
+
+    # imports pywikibot, so only when needed
+    import revisions
+
+    if args.corpus:
+        corpus = mockapi.read_corpus(args.corpus)
+    else:
+        corpus = mockapi.generate_corpus(n_pages=args.pages,
+                                         revisions_per_page=args.revisions_per_page,
+                                         seed=args.seed)
+
+    server = mockapi.MockAPIServer(corpus,
+                                   latency=args.latency,
+                                   revision_latency=args.revision_latency,
+                                   max_content=args.max_content,
+                                   error_rate=args.error_rate,
+                                   error_code=args.error_code,
+                                   seed=args.seed)
+    server.start()
+    site = mockapi.mock_site(server.url)
+
+    # fetch in batches, the way clean_article() does
+    def fetch():
+        fetched = []
+        revids = sorted(corpus)
+        i = 0
+        while i < len(revids):
+            batch = [FetchRevision(revid) for revid in revids[i:i+args.batch]]
+            revisions.get_revisions(site, batch)
+            fetched.extend(batch)
+            i += args.batch
+        return fetched
+
+    n_requests = server.n_requests
+    (fetched, stats) = measure('get_revisions', None, fetch)
+    stats['requests'] = server.n_requests - n_requests
+    stats['revisions'] = len(fetched)
+    stats['missing_content'] = sum(1 for rev in fetched if rev.content is None)
+    stats['errors_injected'] = server.n_errors
+
+    server.stop()
+    return [stats]
+
+def bench_clean(args):
+    '''
+    Benchmark cleaning a dataset, replaying recorded traffic.
+    '''
+
+    script = load_script('clean-training-set.py')
+    finder = script.AssessmentFinder(replay_file=args.replay)
+
+    with open(args.dataset) as infile:
+        n_articles = sum(1 for line in infile) - 1 # header
+
+    (result, stats) = measure('clean_training_set', None,
+                              finder.clean_training_set,
+                              args.dataset, args.output)
+    stats['articles'] = n_articles
+    stats['articles_per_second'] = n_articles / max(stats['seconds'], 1e-9)
+    return [stats]
+
+def bench_banners(args):
+    '''
+    Benchmark assessment extraction, comparing the scanner
+    with the parser.
+    '''
+
+    import banners
+
+    if args.corpus:
+        corpus = mockapi.read_corpus(args.corpus)
+    else:
+        corpus = mockapi.generate_corpus(n_pages=args.pages,
+                                         revisions_per_page=args.revisions_per_page,
+                                         seed=args.seed)
+
+    # clean_article() looks at the banner region of each revision
+    translations = {u'maths rating': u'wikiproject mathematics'}
+    texts = [banners.banner_region(corpus[revid]['content'],
+                                   limit=args.max_length,
+                                   translations=translations)
+             for revid in sorted(corpus)]
+
+    def extract(func):
+        return [func(text, translations) for text in texts]
+
+    (parsed, parse_stats) = measure('parse_assessments', None, extract,
+                                    banners.parse_assessments)
+    (found, stats) = measure('get_assessments', None, extract,
+                             banners.get_assessments)
+
+    stats['revisions'] = len(texts)
+    stats['scanned'] = sum(1 for text in texts
+                           if banners.scan_assessments(text, translations) is not None)
+    stats['mismatches'] = sum(1 for (a, b) in zip(parsed, found) if a != b)
+    stats['speedup'] = parse_stats['seconds'] / max(stats['seconds'], 1e-9)
+    results = [parse_stats, stats]
+
+    # The banner region has to hold the same assessments as the
+    # first max_length characters, which clean_article() used to parse,
+    # also on pages that start with a section
+    windows = [corpus[revid]['content'][:args.max_length]
+               for revid in sorted(corpus)]
+    stats['region_mismatches'] = sum(
+        1 for (window, assessments) in zip(windows, found)
+        if banners.parse_assessments(window, translations) != assessments)
+
+    if args.processes:
+        # parse everything in the pool, all revisions at once
+        pool = banners.AssessmentPool(args.processes, translations,
+                                      scan=False, chunksize=args.chunksize)
+        def extract_pool():
+            return list(pool.imap(texts))
+        (found, pool_stats) = measure('AssessmentPool', None, extract_pool)
+        pool.close()
+        pool_stats['processes'] = args.processes
+        pool_stats['mismatches'] = sum(1 for (a, b) in zip(parsed, found) if a != b)
+        pool_stats['speedup'] = parse_stats['seconds'] / max(pool_stats['seconds'], 1e-9)
+        results.append(pool_stats)
+
+    return results
+
+def bench_startup(args):
+    '''
+    Benchmark script startup, running each script in a new process.
+    '''
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    # a dataset with just the header, which should need no connections
+    (fd, dataset) = tempfile.mkstemp(suffix='.tsv')
+    with os.fdopen(fd, 'w') as outfile:
+        outfile.write('class\tpageid\n')
+
+    runs = [('get-articles-by-assessment.py --help',
+             ['get-articles-by-assessment.py', '--help']),
+            ('sample-articles.py --help',
+             ['sample-articles.py', '--help']),
+            ('clean-training-set.py --help',
+             ['clean-training-set.py', '--help']),
+            ('clean-training-set.py empty dataset',
+             ['clean-training-set.py', dataset, os.devnull])]
+
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for (name, command) in runs:
+            command = [sys.executable, os.path.join(directory, command[0])] + command[1:]
+            times = []
+            for i in range(args.repeat):
+                start = time.time()
+                returncode = subprocess.call(command, stdout=devnull,
+                                             stderr=devnull)
+                times.append(time.time() - start)
+            times.sort()
+            results.append({'name': name,
+                            'seconds': times[len(times)//2],
+                            'min_seconds': times[0],
+                            'max_seconds': times[-1],
+                            'returncode': returncode,
+                            'peak_traced_bytes': None,
+                            'max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss})
+
+    os.remove(dataset)
+    return results
+
+def main():
+    import argparse
+
+    cli_parser = argparse.ArgumentParser(
+        description="Run benchmarks against local stand-ins for the replica and API."
+        )
+
+    cli_parser.add_argument("-v", "--verbose", action="store_true",
+                            help="write informational output")
+
+    cli_parser.add_argument("--json", metavar="<json-path>", default=None,
+                            help="write measurements to this JSON file")
+
+    subparsers = cli_parser.add_subparsers(dest='benchmark')
+
+    extract_parser = subparsers.add_parser(
+        'extract', help='category extraction from a synthetic replica')
+    extract_parser.add_argument("--db", metavar="<db-path>", default=None,
+                                help="path to the synthetic replica, generated if it does not exist (default: temporary file)")
+    extract_parser.add_argument("--projects", type=int, default=5,
+                                help="number of WikiProjects (default: 5)")
+    extract_parser.add_argument("--depth", type=int, default=2,
+                                help="depth of each class's category tree (default: 2)")
+    extract_parser.add_argument("--fanout", type=int, default=3,
+                                help="sub-categories per category (default: 3)")
+    extract_parser.add_argument("--articles", type=int, default=10000,
+                                help="number of articles (default: 10000)")
+    extract_parser.add_argument("--redirect-ratio", type=float, default=0.1,
+                                help="proportion of redirects (default: 0.1)")
+    extract_parser.add_argument("--seed", type=int, default=0,
+                                help="random seed (default: 0)")
+    extract_parser.add_argument("--classes", default=','.join(synthdb.CLASSES),
+                                help="comma-separated classes to extract (default: all)")
+    extract_parser.add_argument("--category-cache", metavar="<cache-path>",
+                                default=None,
+                                help="category tree cache file to use")
+
+    revisions_parser = subparsers.add_parser(
+        'revisions', help='revision fetches from a mock API')
+    revisions_parser.add_argument("--corpus", metavar="<corpus-path>",
+                                  default=None,
+                                  help="fixture corpus of revisions, one JSON object per line (default: generated)")
+    revisions_parser.add_argument("--pages", type=int, default=100,
+                                  help="number of talk pages to generate (default: 100)")
+    revisions_parser.add_argument("--revisions-per-page", type=int,
+                                  default=50,
+                                  help="revisions per generated talk page (default: 50)")
+    revisions_parser.add_argument("--seed", type=int, default=0,
+                                  help="random seed (default: 0)")
+    revisions_parser.add_argument("--batch", type=int, default=20,
+                                  help="revisions per get_revisions() call (default: 20)")
+    revisions_parser.add_argument("--latency", type=float, default=0.0,
+                                  help="seconds of latency per request (default: 0)")
+    revisions_parser.add_argument("--revision-latency", type=float,
+                                  default=0.0,
+                                  help="additional seconds per revision returned (default: 0)")
+    revisions_parser.add_argument("--max-content", type=int, default=50,
+                                  help="revisions returned per request before query-continue (default: 50)")
+    revisions_parser.add_argument("--error-rate", type=float, default=0.0,
+                                  help="probability that a request fails (default: 0)")
+    revisions_parser.add_argument("--error-code", default='maxlag',
+                                  help="API error code of injected errors, or http503 (default: maxlag)")
+
+    clean_parser = subparsers.add_parser(
+        'clean', help='dataset cleaning, replaying recorded traffic')
+    clean_parser.add_argument("replay", metavar="<recording-path>",
+                              help="traffic recorded by clean-training-set.py --record")
+    clean_parser.add_argument("dataset", metavar="<dataset-path>",
+                              help="the dataset the recording was made with")
+    clean_parser.add_argument("--output", metavar="<output-path>",
+                              default=os.devnull,
+                              help="path to write the cleaned dataset to (default: discard)")
+
+    banners_parser = subparsers.add_parser(
+        'banners', help='assessment extraction, scanner against parser')
+    banners_parser.add_argument("--corpus", metavar="<corpus-path>",
+                                default=None,
+                                help="fixture corpus of revisions, one JSON object per line (default: generated)")
+    banners_parser.add_argument("--pages", type=int, default=100,
+                                help="number of talk pages to generate (default: 100)")
+    banners_parser.add_argument("--revisions-per-page", type=int,
+                                default=50,
+                                help="revisions per generated talk page (default: 50)")
+    banners_parser.add_argument("--seed", type=int, default=0,
+                                help="random seed (default: 0)")
+    banners_parser.add_argument("--max-length", type=int, default=8*1024,
+                                help="characters of each revision to look at if it has no early section heading (default: 8192)")
+    banners_parser.add_argument("--processes", type=int, default=None,
+                                help="also parse in a pool of this many processes")
+    banners_parser.add_argument("--chunksize", type=int, default=32,
+                                help="largest number of revisions sent to a pool worker at once (default: 32)")
+
+    startup_parser = subparsers.add_parser(
+        'startup', help='script startup time')
+    startup_parser.add_argument("--repeat", type=int, default=5,
+                                help="number of times to run each script, the median time is reported (default: 5)")
+
+    args = cli_parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.benchmark == 'extract':
+        results = bench_extract(args)
+    elif args.benchmark == 'revisions':
+        results = bench_revisions(args)
+    elif args.benchmark == 'clean':
+        results = bench_clean(args)
+    elif args.benchmark == 'banners':
+        results = bench_banners(args)
+    elif args.benchmark == 'startup':
+        results = bench_startup(args)
+
+    report(results, args.json)
+
+    # ok, done
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Disk cache of the assessment category trees.
+
+The sub-category closure of each assessment class changes rarely, so we
+store the valid child categories of every category we have walked, together
+with its member counts from the category table and the time its newest
+sub-category was added.  On startup these are checked in bulk against the
+category and categorylinks tables, and only categories whose sub-category
+count or newest sub-category has changed are walked again.  A category
+that swaps one sub-category for another keeps its count, but the new link
+is the newest.
+'''
+
+import os
+import json
+import logging
+
+class CategoryCache:
+    def __init__(self, filename):
+        '''
+        Instantiate the cache, reading it from disk if it exists.
+
+        @param filename: path to the cache file
+        @type filename: str
+        '''
+
+        self.filename = os.path.expanduser(filename)
+
+        # Maps assessment class to a dict mapping category page ID (as str)
+        # to a dict with the category's valid child categories ('children'),
+        # its page and sub-category counts ('pages', 'subcats'), and the
+        # timestamp of its newest sub-category link ('linked')
+        self.classes = {}
+
+        # Categories (class, page ID) that have to be walked again
+        self.stale = set()
+
+        # Have we checked the cache against the category table yet?
+        self.validated = False
+
+        # Query to get page and sub-category counts and the newest
+        # sub-category link for a set of categories, categories with
+        # no members have no row in the category table.
+        self.count_query = ur'''SELECT page_id, cat_pages, cat_subcats,
+                                       (SELECT MAX(cl_timestamp)
+                                        FROM categorylinks
+                                        WHERE cl_to=page_title
+                                        AND cl_type="subcat") AS linked
+                                FROM page
+                                JOIN category
+                                ON page_title=cat_title
+                                WHERE page_namespace=14
+                                AND page_id IN ({pageidlist})'''
+
+        self.slice_size = 1000
+
+        self.load()
+
+    def load(self):
+        '''
+        Read the cache from disk, if it exists.
+        '''
+
+        if not os.path.exists(self.filename):
+            logging.info('no category cache found at {0}'.format(self.filename))
+            return
+
+        try:
+            with open(self.filename, 'r') as infile:
+                self.classes = json.load(infile)
+        except (IOError, ValueError) as e:
+            logging.warning('unable to read category cache {0}: {1}'.format(self.filename, e))
+            self.classes = {}
+            return
+
+        logging.info('read cached category trees for {0} classes from {1}'.format(len(self.classes), self.filename))
+
+    def save(self):
+        '''
+        Write the cache to disk.
+        '''
+
+        tmp_filename = '{0}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(self.classes, outfile)
+        os.rename(tmp_filename, self.filename)
+
+        logging.info('wrote category cache to {0}'.format(self.filename))
+
+    def get_counts(self, dbcursor, catids):
+        '''
+        Get page and sub-category counts and the newest sub-category
+        link for the given categories.
+
+        Returns a dict mapping category page ID (as str) to a tuple
+        (cat_pages, cat_subcats, timestamp of the newest sub-category
+        link as str, or None if it has no sub-categories).
+
+        @param dbcursor: database cursor to use for the queries
+        @type dbcursor: MySQLdb.cursors.SSDictCursor
+
+        @param catids: page IDs (as str) of the categories
+        @type catids: list
+        '''
+
+        # empty categories are not in the category table
+        counts = dict((catid, (0, 0, None)) for catid in catids)
+
+        i = 0
+        while i < len(catids):
+            dbcursor.execute(self.count_query.format(
+                pageidlist=",".join(catids[i:i+self.slice_size])))
+            for row in dbcursor.fetchall():
+                linked = row['linked']
+                if linked is not None:
+                    linked = str(linked)
+                counts[str(row['page_id'])] = (row['cat_pages'],
+                                               row['cat_subcats'],
+                                               linked)
+            i += self.slice_size
+
+        return counts
+
+    def validate(self, dbcursor):
+        '''
+        Check all cached categories against the category table and mark
+        those whose sub-category count or newest sub-category link has
+        changed as stale.
+
+        @param dbcursor: database cursor to use for the queries
+        @type dbcursor: MySQLdb.cursors.SSDictCursor
+        '''
+
+        if self.validated:
+            return
+
+        catids = set()
+        for categories in self.classes.values():
+            catids.update(categories.keys())
+
+        counts = self.get_counts(dbcursor, list(catids))
+
+        for assessment_class, categories in self.classes.items():
+            for catid, catdata in categories.items():
+                (n_pages, n_subcats, linked) = counts[catid]
+                if (n_subcats != catdata['subcats']
+                    or linked != catdata.get('linked')):
+                    self.stale.add((assessment_class, catid))
+                catdata['pages'] = n_pages
+
+        logging.info('validated {n} cached categories, {k} need to be walked again'.format(n=len(catids), k=len(self.stale)))
+        self.validated = True
+
+    def children(self, assessment_class, catid):
+        '''
+        Get the cached valid child categories of the given category,
+        or None if the category is not cached or is stale.
+
+        @param assessment_class: assessment class we're traversing
+        @type assessment_class: str
+
+        @param catid: page ID (as str) of the category
+        @type catid: str
+        '''
+
+        if (assessment_class, catid) in self.stale:
+            return None
+
+        try:
+            return self.classes[assessment_class][catid]['children']
+        except KeyError:
+            return None
+
+    def store(self, assessment_class, catid, children, counts):
+        '''
+        Store the valid child categories of the given category.
+
+        @param assessment_class: assessment class we're traversing
+        @type assessment_class: str
+
+        @param catid: page ID (as str) of the category
+        @type catid: str
+
+        @param children: page IDs (as str) of the valid child categories
+        @type children: list
+
+        @param counts: the category's counts and newest sub-category link
+                       as returned by get_counts(), read before its
+                       children were fetched
+        @type counts: tuple
+        '''
+
+        self.classes.setdefault(assessment_class, {})[catid] = {
+            'children': children,
+            'pages': counts[0],
+            'subcats': counts[1],
+            'linked': counts[2]}
+        self.stale.discard((assessment_class, catid))
+
+    def page_count(self, assessment_class, catids):
+        '''
+        Sum the cached page counts of the given categories.
+
+        @param assessment_class: assessment class we're traversing
+        @type assessment_class: str
+
+        @param catids: page IDs (as str) of the categories
+        @type catids: list
+        '''
+
+        categories = self.classes.get(assessment_class, {})
+        return sum(categories[catid]['pages'] for catid in catids
+                   if catid in categories)
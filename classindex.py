@@ -0,0 +1,193 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Memory-mapped page ID to assessment class index.
+
+The index is a binary file with a small header listing the assessment
+classes, followed by the sorted page IDs as little-endian uint32s and
+then one byte per page ID giving its class.  Because the file is
+memory-mapped, any number of processes can share it without loading it,
+and lookups are binary searches over the page ID column.
+
+If numpy is installed, batch lookups are vectorised.
+'''
+
+import os
+import mmap
+import struct
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'ACI1'
+
+# magic, number of records, number of classes
+HEADER = struct.Struct('<4sIB')
+
+class IndexWriter:
+    def __init__(self, filename, classes):
+        '''
+        Open the index file for writing.  Rows have to be written
+        in increasing page ID order.
+
+        @param filename: path to the index file
+        @type filename: str
+
+        @param classes: assessment class names
+        @type classes: list
+        '''
+
+        self.outfile = open(os.path.expanduser(filename), 'wb')
+        self.classes = list(classes)
+        self.class_codes = dict((classname, code)
+                                for (code, classname) in enumerate(classes))
+
+        # header with a placeholder count, filled in on close
+        header = [HEADER.pack(MAGIC, 0, len(self.classes))]
+        for classname in self.classes:
+            classname = classname.encode('utf-8')
+            header.append(struct.pack('<B', len(classname)))
+            header.append(classname)
+        header = b''.join(header)
+        # pad so that the page ID column is aligned
+        header += b'\x00' * (-len(header) % 4)
+        self.outfile.write(header)
+
+        self.n_records = 0
+        self.last_pageid = -1
+        self.codes = bytearray()
+
+    def write(self, row):
+        '''
+        Add a page to the index.
+
+        @param row: page ID and assessment class of the page
+        @type row: tuple
+        '''
+
+        (pageid, assessment_class) = row
+        if pageid <= self.last_pageid:
+            raise ValueError('page IDs must be written in increasing order')
+        self.last_pageid = pageid
+
+        self.outfile.write(struct.pack('<I', pageid))
+        self.codes.append(self.class_codes[assessment_class])
+        self.n_records += 1
+
+    def close(self):
+        self.outfile.write(self.codes)
+        self.outfile.seek(0)
+        self.outfile.write(HEADER.pack(MAGIC, self.n_records,
+                                       len(self.classes)))
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _PageIDColumn:
+    '''
+    Sequence view of the page ID column, used for bisection.
+    '''
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self.buf, self.offset + 4*i)[0]
+
+class ClassIndex:
+    def __init__(self, filename):
+        '''
+        Open and memory-map the given index file.
+
+        @param filename: path to the index file
+        @type filename: str
+        '''
+
+        with open(os.path.expanduser(filename), 'rb') as infile:
+            self.buf = mmap.mmap(infile.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        (magic, self.n_records, n_classes) = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a class index'.format(filename))
+
+        offset = HEADER.size
+        self.classes = []
+        for i in range(n_classes):
+            length = struct.unpack_from('<B', self.buf, offset)[0]
+            offset += 1
+            self.classes.append(self.buf[offset:offset+length].decode('utf-8'))
+            offset += length
+        offset += -offset % 4
+
+        self.pageid_offset = offset
+        self.class_offset = offset + 4*self.n_records
+        self.pageids = _PageIDColumn(self.buf, self.pageid_offset,
+                                     self.n_records)
+
+    def __len__(self):
+        return self.n_records
+
+    def lookup(self, pageid):
+        '''
+        Get the assessment class of the given page, or None
+        if the page is not in the index.
+
+        @param pageid: page ID of the article
+        @type pageid: int
+        '''
+
+        i = bisect.bisect_left(self.pageids, pageid)
+        if i == self.n_records or self.pageids[i] != pageid:
+            return None
+        return self.classes[ord(self.buf[self.class_offset + i:
+                                         self.class_offset + i + 1])]
+
+    def lookup_many(self, pageids):
+        '''
+        Get the assessment classes of many pages at once.  Returns a list
+        in the same order as the given page IDs, with None for pages
+        that are not in the index.
+
+        @param pageids: page IDs of the articles
+        @type pageids: list
+        '''
+
+        if numpy is None:
+            return [self.lookup(pageid) for pageid in pageids]
+
+        column = numpy.frombuffer(self.buf, dtype='<u4',
+                                  count=self.n_records,
+                                  offset=self.pageid_offset)
+        codes = numpy.frombuffer(self.buf, dtype='u1',
+                                 count=self.n_records,
+                                 offset=self.class_offset)
+
+        queries = numpy.asarray(pageids, dtype='<u4')
+        positions = numpy.searchsorted(column, queries)
+        positions = numpy.minimum(positions, max(self.n_records - 1, 0))
+        if self.n_records:
+            found = column[positions] == queries
+        else:
+            found = numpy.zeros(len(queries), dtype=bool)
+
+        result = [None] * len(queries)
+        for (i, code) in zip(numpy.flatnonzero(found),
+                             codes[positions[found]]):
+            result[i] = self.classes[code]
+        return result
+
+    def close(self):
+        self.buf.close()
@@ -9,48 +9,276 @@ a new dataset.
 
 import db
 
-import re
 import sys
 import logging
 import codecs
-
-import pywikibot
-import mwparserfromhell as mwp
+import itertools
 
 from collections import namedtuple
 
 import MySQLdb
 
-from assessment import Assessment
+from assessment import Assessment, wp10_scale
+import banners
 import revisions
-
-class TPRevision:
-    def __init__(self, id, timestamp, content=None):
+from batching import AdaptiveSlice
+import replay
+import timing
+import timeline
+import pruning
+from timelinecache import TimelineCache
+import tracing
+import apischeduler
+
+class TPRevision(object):
+    __slots__ = ('id', 'timestamp', 'content', 'length', 'comment', 'user')
+
+    def __init__(self, id, timestamp, content=None,
+                 length=None, comment=None, user=None):
         self.id = id
         self.timestamp = timestamp
         self.content = content
 
+        # Metadata used for pruning, see pruning.py
+        self.length = length
+        self.comment = comment
+        self.user = user
+
+class TalkRevisions:
+    '''
+    Revisions of a talk page made before a given article revision, newest
+    first, listed in pages as they are needed rather than all at once,
+    since we rarely look at more than the newest few dozen.  Each page
+    continues from the last revision of the one before by timestamp and
+    revision ID (keyset pagination), so later pages are as cheap to list
+    as the first.  Pages double in size up to a limit.
+
+    Can be iterated over, indexed and sliced like a list, but taking its
+    length lists all of the revisions.  If listing fails, the revisions
+    end early and failed is set.
+    '''
+
+    def __init__(self, finder, talkpageid, revid, page_size=50,
+                 max_page_size=1000):
+        self.finder = finder
+        self.talkpageid = talkpageid
+        self.revid = revid
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+        # Revisions listed so far, have we listed all of them,
+        # and did listing fail?
+        self.revisions = []
+        self.exhausted = False
+        self.failed = False
+
+    def _fill(self, n=None):
+        '''
+        List revisions until we have n of them, or all of them.
+        '''
+
+        while not self.exhausted \
+                and (n is None or len(self.revisions) < n):
+            last = None
+            if self.revisions:
+                last = self.revisions[-1]
+            revisions = self.finder.list_talk_revisions(
+                self.talkpageid, self.revid, last, self.page_size)
+            if revisions is None:
+                self.failed = True
+                revisions = []
+            if len(revisions) < self.page_size:
+                self.exhausted = True
+            self.revisions.extend(revisions)
+            self.page_size = min(self.max_page_size, self.page_size * 2)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is None or index.stop < 0 \
+                    or (index.start or 0) < 0:
+                self._fill()
+            else:
+                self._fill(index.stop)
+        elif index < 0:
+            self._fill()
+        else:
+            self._fill(index + 1)
+        return self.revisions[index]
+
+    def __iter__(self):
+        i = 0
+        while True:
+            self._fill(i + 1)
+            if i >= len(self.revisions):
+                return
+            yield self.revisions[i]
+            i += 1
+
+    def __len__(self):
+        self._fill()
+        return len(self.revisions)
+
+    def __nonzero__(self):
+        self._fill(1)
+        return bool(self.revisions)
+
+    def index(self, revision):
+        for (i, listed) in enumerate(self):
+            if listed is revision:
+                return i
+        raise ValueError('revision {0} is not listed'.format(revision.id))
+
 class AssessmentFinder:
-    def __init__(self, is_training=False):
+    def __init__(self, is_training=False, record_file=None, replay_file=None,
+                 timer=None, tracer=None, slow_queries=None,
+                 scheduler=None, processes=None, timeline_cache=None,
+                 prune=False, bulk_resolve=False):
         '''
         Instantiate finder.
 
         @param is_training: are we getting clean data for the training set?
                            (if true, we move backwards in time, else forward)
         @type is_training: bool
+
+        @param record_file: path to a file to record all database
+                            and API traffic to
+        @type record_file: str
+
+        @param replay_file: path to a recording to replay database
+                            and API traffic from, instead of using
+                            the network
+        @type replay_file: str
+
+        @param timer: stage timer to report where the time goes
+        @type timer: timing.StageTimer
+
+        @param tracer: tracer recording queries, API requests and
+                       articles to a trace file
+        @type tracer: tracing.Tracer
+
+        @param slow_queries: log queries taking at least this many
+                             seconds, with their EXPLAIN output
+        @type slow_queries: float
+
+        @param scheduler: scheduler keeping API requests within a budget,
+                          by default the one shared by all finders
+        @type scheduler: apischeduler.APIScheduler
+
+        @param processes: number of processes to parse talk page
+                          revisions in, if more than one
+        @type processes: int
+
+        @param timeline_cache: path to a cache of talk page timelines,
+                               so that pages cleaned before only have
+                               their new revisions assessed
+        @type timeline_cache: str
+
+        @param prune: use revision metadata to pick the talk page
+                      revisions most likely to change the assessment,
+                      and fetch those first
+        @type prune: bool
+
+        @param bulk_resolve: find the article revision at the time of each
+                             article's talk page revision for all articles
+                             at once, after cleaning them, rather than for
+                             one article at a time
+        @type bulk_resolve: bool
         '''
 
         self.is_training = is_training
+        self.prune = prune
+        self.bulk_resolve = bulk_resolve
+
+        self.timer = timer
+        if not self.timer:
+            self.timer = timing.NullTimer()
+
+        self.tracer = tracer
+        if not self.tracer:
+            self.tracer = tracing.NullTracer()
+
+        # Recorder or replayer of database and API traffic, if any
+        self.traffic = None
+        if replay_file:
+            self.traffic = replay.Replayer(replay_file)
+        elif record_file:
+            self.traffic = replay.Recorder(record_file)
+
+        # Revisions per API request, adapted to how fast the API answers
+        # unless we record or replay traffic, which is only replayable
+        # if the requests are the same every time.
+        self.revision_slices = revisions.revision_slices
+        if self.traffic:
+            self.revision_slices = AdaptiveSlice(size=10, minimum=10, maximum=10)
+
+        # Log of slow queries, if any
+        self.slowlog = None
+        if slow_queries is not None:
+            self.slowlog = db.SlowQueryLog(slow_queries)
 
-        (self.dbconn, self.dbcursor) = db.connect()
         self.db_attempts = 3 # number of query attempts
 
-        self.site = pywikibot.Site('en')
-        self.site.login()
+        # Scheduler of API requests, unless they are replayed
+        self.scheduler = None
+        if not replay_file:
+            self.scheduler = scheduler
+            if not self.scheduler:
+                self.scheduler = apischeduler.api_scheduler
+
+        # The database connection and site are opened on first use,
+        # see connect()
+        self.dbconn = None
+        self.dbcursor = None
+        self.site = None
 
         # Translations of known templates
         self.translations = {u'maths rating': u'wikiproject mathematics'}
 
+        # Pool of processes parsing revisions, if any
+        self.parser_pool = None
+        if processes and processes > 1:
+            self.parser_pool = banners.AssessmentPool(processes,
+                                                      self.translations)
+
+        # Cache of talk page timelines, if any
+        self.timeline_cache = None
+        if timeline_cache:
+            self.timeline_cache = TimelineCache(timeline_cache)
+
+    def connect(self):
+        '''
+        Connect to the database and log in to the site, unless done
+        already.  This is deferred until there is work to do, so that
+        the script starts quickly and does not connect for nothing.
+        '''
+
+        if self.dbconn is None:
+            self.db_connect()
+
+        if self.site is None:
+            if self.traffic:
+                site = self.traffic.site('en')
+            else:
+                import pywikibot
+                site = pywikibot.Site('en')
+            if self.scheduler:
+                site = apischeduler.ScheduledSite(site, self.scheduler)
+            site = self.tracer.wrap_site(site)
+            site.login()
+            self.site = site
+
+    def db_connect(self):
+        '''
+        Open the database connection, recording or replaying
+        its traffic if asked to.
+        '''
+
+        if self.traffic:
+            (self.dbconn, self.dbcursor) = self.traffic.connect(slowlog=self.slowlog)
+        else:
+            (self.dbconn, self.dbcursor) = db.connect(slowlog=self.slowlog)
+        self.dbcursor = self.tracer.wrap_cursor(self.dbcursor)
+
     def get_assessments(self, rev_content):
         '''
         For the given revision content, get all assessments.
@@ -60,28 +288,22 @@ class AssessmentFinder:
         @type rev_content: unicode
         '''
 
-        parsed_code = mwp.parse(rev_content)
-        templates = parsed_code.filter_templates()
-        assessments = []
-        for temp in templates:
-            if re.match('wikiproject\s+',
-                        unicode(temp.name),
-                        re.I) \
-                or unicode(temp.name) in self.translations \
-                or temp.has_param('class'):
-                project = unicode(temp.name).lower()
-                try:
-                    rating = unicode(temp.get('class').value).strip().lower()
-                except ValueError:
-                    continue # no assessment class in template
-                importance = None
-                if temp.has_param('importance'):
-                    importance = unicode(temp.get('importance').value).strip().lower()
-                assessments.append(Assessment(rating,
-                                              importance,
-                                              project))
-        # return all assessments
-        return assessments
+        return [Assessment(rating, importance, project)
+                for (project, rating, importance)
+                in banners.get_assessments(rev_content, self.translations)]
+
+    def get_batch_assessments(self, rev_contents):
+        '''
+        For each of the given revision contents, get all assessments,
+        using the pool of parsers.
+
+        @param rev_contents: wikitext content of talk page revisions
+        @type rev_contents: list
+        '''
+
+        return [[Assessment(rating, importance, project)
+                 for (project, rating, importance) in assessments]
+                for assessments in self.parser_pool.get_assessments(rev_contents)]
 
     def clean_training_set(self, dataset_filename, output_filename):
         '''
@@ -112,31 +334,63 @@ class AssessmentFinder:
                                  'class': cols[0]})
 
         print('Got dataset with {n} articles'.format(n=len(articles)))
+
+        if self.bulk_resolve:
+            # clean all articles, then find their article revisions
+            pending = []
+            for article in articles:
+                with self.timer.article(article['pageid']), \
+                        self.tracer.span('article', 'article',
+                                         pageid=article['pageid']):
+                    if self.clean_article(article, resolve=False):
+                        pending.append(article)
+
+            print('Finding article revisions for {n} articles'.format(n=len(pending)))
+            with self.timer.stage('resolve_article_revisions'):
+                found = self.resolve_article_revisions(
+                    [(article['pageid'], article['talkpagerev'])
+                     for article in pending])
+            for (article, article_revision) in zip(pending, found):
+                if not article_revision:
+                    logging.error('unable to find article revision for talk page revision ID {0}'.format(article['talkpagerev']))
+                    continue
+                article['revid'] = article_revision
+
         # write out new dataset
         with codecs.open(output_filename, 'w+', 'utf-8') as outfile:
             outfile.write(u'pageid\trevid\ttalkpageid\ttalkpagerevid\tclass\n')
 
             i = 0
             for article in articles:
-                self.clean_article(article)
+                if not self.bulk_resolve:
+                    with self.timer.article(article['pageid']), \
+                            self.tracer.span('article', 'article',
+                                             pageid=article['pageid']):
+                        self.clean_article(article)
                 outfile.write(u'{pageid}\t{revid}\t{talkpageid}\t{talkpagerev}\t{class}\n'.format(**article))
                 i += 1
                 if i % 500 == 0:
                     print('Written {0} articles to {1}'.format(i, output_filename))
                     sys.stdout.flush()
 
+        if self.traffic:
+            self.traffic.save()
+        if self.timeline_cache:
+            self.timeline_cache.save()
+        self.tracer.save()
+
         return
 
     def get_recent_assessments(self, revid):
         '''
         Get all assessments for the article with the given revision ID.
 
-        Assumes a working database connection is established.
-
         @param revid: revision ID of the page we're examining
         @type revid: long
         '''
-        
+
+        import pywikibot
+
         # find the page title and timestamp of the given revision
         tt_query = ur'''SELECT rev_timestamp, page_title
                         FROM revision JOIN page on rev_page=page_id
@@ -156,6 +410,8 @@ class AssessmentFinder:
             logging.error('Cannot find assessments without an article revid')
             return []
 
+        self.connect()
+
         rev_timestamp = None
         page_title = None
         self.dbcursor.execute(tt_query,
@@ -253,7 +509,7 @@ class AssessmentFinder:
                 logging.error('unable to execute revert test queries')
                 logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
                 db.disconnect(self.dbconn, self.dbcursor)
-                (self.dbconn, self.dbcursor) = db.connect()
+                self.db_connect()
             else:
                 break # ok, done
 
@@ -271,12 +527,427 @@ class AssessmentFinder:
             
         return False
         
-    def clean_article(self, articledata):
+    def get_talk_revisions(self, talkpageid, revid, mark=None):
+        '''
+        Get the revisions of the given talk page made before the given
+        article revision, newest first and listed as they are needed (see
+        TalkRevisions), or if a high-water mark is given only those made
+        after it, oldest first.  Returns None if listing the revisions
+        after a mark failed.
+
+        @param talkpageid: page ID of the talk page
+        @type talkpageid: int
+
+        @param revid: revision ID of the article
+        @type revid: int
+
+        @param mark: revision ID and timestamp of the newest talk page
+                     revision looked at before
+        @type mark: tuple
+        '''
+
+        # Query to get the revisions of a talk page made after
+        # a high-water mark and before a given article revision.
+        tp_newquery = ur'''SELECT {columns}
+                           FROM revision
+                           WHERE rev_page=%(talkpageid)s
+                           AND (rev_timestamp > %(mark_timestamp)s
+                                OR (rev_timestamp = %(mark_timestamp)s
+                                    AND rev_id > %(mark)s))
+                           AND rev_timestamp < (SELECT rev_timestamp
+                           FROM revision
+                           WHERE rev_id=%(revid)s)
+                           ORDER BY rev_timestamp ASC, rev_id ASC'''
+
+        if not mark:
+            return TalkRevisions(self, talkpageid, revid)
+
+        (mark, mark_timestamp) = mark
+        return self.query_talk_revisions(tp_newquery,
+                                         {'talkpageid': talkpageid,
+                                          'revid': revid,
+                                          'mark': mark,
+                                          'mark_timestamp': mark_timestamp})
+
+    def list_talk_revisions(self, talkpageid, revid, last=None, limit=50):
+        '''
+        List a page of the revisions of the given talk page made before
+        the given article revision, newest first.  Returns None if the
+        query failed.
+
+        @param talkpageid: page ID of the talk page
+        @type talkpageid: int
+
+        @param revid: revision ID of the article
+        @type revid: int
+
+        @param last: last revision of the previous page, if any
+        @type last: TPRevision
+
+        @param limit: number of revisions to list
+        @type limit: int
+        '''
+
+        # Query to get the newest revisions of a given talk page
+        # based on the timestamp of a given article revision.
+        tp_revquery = ur'''SELECT {columns}
+                           FROM revision
+                           WHERE rev_page=%(talkpageid)s
+                           AND rev_timestamp < (SELECT rev_timestamp
+                           FROM revision
+                           WHERE rev_id=%(revid)s)
+                           ORDER BY rev_timestamp DESC, rev_id DESC
+                           LIMIT %(limit)s'''
+
+        # Query to get the next revisions of a talk page,
+        # those older than the last one listed.
+        tp_nextquery = ur'''SELECT {columns}
+                            FROM revision
+                            WHERE rev_page=%(talkpageid)s
+                            AND (rev_timestamp < %(last_timestamp)s
+                                 OR (rev_timestamp = %(last_timestamp)s
+                                     AND rev_id < %(last)s))
+                            ORDER BY rev_timestamp DESC, rev_id DESC
+                            LIMIT %(limit)s'''
+
+        if last is None:
+            return self.query_talk_revisions(tp_revquery,
+                                             {'talkpageid': talkpageid,
+                                              'revid': revid,
+                                              'limit': limit})
+
+        return self.query_talk_revisions(tp_nextquery,
+                                         {'talkpageid': talkpageid,
+                                          'last': last.id,
+                                          'last_timestamp': last.timestamp,
+                                          'limit': limit})
+
+    def query_talk_revisions(self, query, params):
+        '''
+        Run a query listing talk page revisions.  Returns None if the
+        query failed.
+
+        @param query: the query, with a placeholder for the columns
+        @type query: unicode
+
+        @param params: parameters of the query
+        @type params: dict
+        '''
+
+        # with metadata for pruning, if we prune
+        columns = u'rev_id, rev_timestamp'
+        if self.prune:
+            columns += u', rev_len, rev_comment, rev_user_text'
+        query = query.format(columns=columns)
+
+        tp_revs = []
+        attempts = 0
+        while attempts < self.db_attempts:
+            try:
+                with self.timer.stage('tp_revquery'):
+                    tp_revs = []
+                    self.dbcursor.execute(query, params)
+                    for row in self.dbcursor:
+                        revision = TPRevision(row['rev_id'],
+                                              row['rev_timestamp'])
+                        if self.prune:
+                            revision.length = row['rev_len']
+                            revision.comment = row['rev_comment']
+                            revision.user = row['rev_user_text']
+                        tp_revs.append(revision)
+                logging.info('found {0} talk page revisions to inspect'.format(len(tp_revs)))
+            except MySQLdb.OperationalError as e:
+                attempts += 1
+                logging.error('unable to execute query to get talk page revisions')
+                logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
+                # reconnect
+                db.disconnect(self.dbconn, self.dbcursor)
+                self.db_connect()
+            else:
+                break # ok, done
+
+        if attempts >= self.db_attempts:
+            logging.error('exhausted query attempts, aborting')
+            return None
+
+        return tp_revs
+
+    def assess_revisions(self, tp_revs, assessed=None, slice_size=20):
+        '''
+        Fetch and assess the given talk page revisions in slices, as they
+        are needed.  Yields each revision with its assessments, which are
+        None if the revision has no content.
+
+        @param tp_revs: talk page revisions, a list or any iterable
+        @type tp_revs: list
+
+        @param assessed: assessments of revisions assessed before, which
+                         are not fetched again, by revision ID; the new
+                         ones are added to it
+        @type assessed: dict
+
+        @param slice_size: number of revisions to fetch at a time
+        @type slice_size: int
+        '''
+
+        if assessed is None:
+            assessed = {}
+
+        tp_revs = iter(tp_revs)
+        while True:
+            rev_subset = list(itertools.islice(tp_revs, slice_size))
+            if not rev_subset:
+                break
+            new_revs = [revision for revision in rev_subset
+                        if not revision.id in assessed]
+            if new_revs:
+                with self.timer.stage('get_revisions'):
+                    revisions.get_revisions(self.site, new_revs,
+                                            slices=self.revision_slices)
+
+            # With a pool of parsers, parse the whole batch at once
+            batch_assessments = {}
+            if self.parser_pool and new_revs:
+                with self.timer.stage('get_assessments'):
+                    batch_assessments = dict(zip(
+                        [revision.id for revision in new_revs],
+                        self.get_batch_assessments(
+                            [banners.banner_region(revision.content or u'',
+                                                   translations=self.translations)
+                             for revision in new_revs])))
+
+            for revision in rev_subset:
+                if revision.id in assessed:
+                    yield (revision, assessed[revision.id])
+                    continue
+
+                logging.info('assessing talk page revision ID {0}'.format(revision.id))
+                # NOTE: The assessments are usually at the top of the
+                # page, above the first section, so we only look at that
+                # part, see banners.banner_region().
+                if not revision.content:
+                    logging.info('revision has no content, skipping')
+                    assessed[revision.id] = None
+                    yield (revision, None)
+                    continue
+
+                region = banners.banner_region(revision.content,
+                                               translations=self.translations)
+                if len(region) < len(revision.content):
+                    logging.info('revision is {0} bytes, looking at the first {1}'.format(len(revision.content), len(region)))
+                    revision.content = region
+                if revision.id in batch_assessments:
+                    assessments = batch_assessments[revision.id]
+                else:
+                    with self.timer.stage('get_assessments'):
+                        assessments = self.get_assessments(revision.content)
+
+                assessed[revision.id] = assessments
+                yield (revision, assessments)
+
+    def reverted_check(self):
+        '''
+        Get a function telling if a revision was reverted, for the
+        timeline builder, which logs and times the checks and remembers
+        their answers.
+        '''
+
+        checked = {}
+        def is_reverted(revid):
+            if not revid in checked:
+                logging.info('found no assessments in this revision')
+                with self.timer.stage('is_reverted'):
+                    checked[revid] = self.is_reverted(revid)
+                if checked[revid]:
+                    logging.info('revision got reverted, continuing...')
+            return checked[revid]
+        return is_reverted
+
+    def build_timeline(self, tp_revs, until=None, intervals=None,
+                       assessed=None, is_reverted=None):
+        '''
+        Build the assessment timeline of a talk page in a single pass over
+        the given revisions, fetching and assessing them in slices.
+
+        @param tp_revs: talk page revisions, newest first, or oldest
+                        first if continuing a timeline
+        @type tp_revs: list
+
+        @param until: function taking the interval the last revision
+                      assessed belongs to, we stop walking the history
+                      once it returns True
+        @type until: function
+
+        @param intervals: timeline of the revisions before the given ones
+                          to continue, from the oldest to the newest
+        @type intervals: list
+
+        @param assessed: assessments of revisions assessed before,
+                         see assess_revisions()
+        @type assessed: dict
+
+        @param is_reverted: function telling if a revision was reverted,
+                            by default a new one from reverted_check()
+        @type is_reverted: function
+        '''
+
+        if is_reverted is None:
+            is_reverted = self.reverted_check()
+
+        builder = timeline.TimelineBuilder(newest_first=intervals is None,
+                                           is_reverted=is_reverted,
+                                           intervals=intervals)
+
+        for (revision, assessments) in self.assess_revisions(tp_revs,
+                                                             assessed):
+            builder.add(revision, assessments)
+            if until and builder.current and until(builder.current):
+                return builder
+
+        return builder
+
+    def find_class_start(self, tp_revs, start_idx, slice_size=5):
+        '''
+        Walk the talk page history back until its class is no longer the
+        given one, like build_timeline() does, fetching the revisions
+        pruning.candidates() picks first.  These are assessed from the
+        newest until one of them has another class, which is where the
+        class most likely changed.  A reassessment can also be part of
+        an edit that is not a candidate, e.g. one adding a discussion,
+        so the history is then walked in order down to the change,
+        reusing the assessments of the candidates.
+
+        @param tp_revs: talk page revisions, newest first
+        @type tp_revs: list
+
+        @param start_idx: rank of the current class
+        @type start_idx: int
+
+        @param slice_size: number of candidates to fetch at a time, kept
+                           small since we expect to stop after a few
+        @type slice_size: int
+        '''
+
+        until = lambda interval: interval.rank != start_idx
+        is_reverted = self.reverted_check()
+        assessed = {}
+
+        # Assess the candidates from the newest, as long as
+        # they have the current class
+        candidates = pruning.candidates(tp_revs)
+        for (revision, assessments) in self.assess_revisions(candidates,
+                                                             assessed,
+                                                             slice_size):
+            if assessments is None:
+                continue
+            ranks = [assessment.rank for assessment in assessments
+                     if assessment.rank is not None]
+            if ranks:
+                if max(ranks) != start_idx:
+                    break
+            elif not is_reverted(revision.id):
+                break
+
+        return self.build_timeline(tp_revs, until, assessed=assessed,
+                                   is_reverted=is_reverted)
+
+    def resolve_article_revisions(self, pairs, slice_size=100):
+        '''
+        Find the most recent revision of each of the given articles at the
+        time of the given talk page revision, or if there is none (the
+        talk page was created just before the article) the first one
+        after.  Returns a list of article revision IDs in the same order
+        as the pairs, with None where no revision was found.
+
+        The pairs are resolved slice_size at a time, each slice in a
+        single query.
+
+        @param pairs: (article page ID, talk page revision ID) tuples
+        @type pairs: list
+
+        @param slice_size: number of pairs to resolve per query
+        @type slice_size: int
+        '''
+
+        # Query to get the most recent revision of each article at the
+        # time of a talk page revision, and the first one after it.
+        # The pairs are a derived table of constants.
+        resolve_query = ur'''SELECT pairs.pair,
+                             (SELECT ar.rev_id
+                              FROM revision ar
+                              WHERE ar.rev_page=pairs.pageid
+                              AND ar.rev_timestamp < tp.rev_timestamp
+                              ORDER BY ar.rev_timestamp DESC
+                              LIMIT 1) AS recent_id,
+                             (SELECT ar.rev_id
+                              FROM revision ar
+                              WHERE ar.rev_page=pairs.pageid
+                              AND ar.rev_timestamp > tp.rev_timestamp
+                              ORDER BY ar.rev_timestamp ASC
+                              LIMIT 1) AS next_id
+                             FROM ({pairs}) AS pairs
+                             JOIN revision tp
+                             ON tp.rev_id=pairs.tp_revid'''
+
+        pair_query = u'SELECT {i} AS pair, %(pageid{i})s AS pageid, %(tp_revid{i})s AS tp_revid'
+
+        if self.dbconn is None:
+            self.db_connect()
+
+        result = [None] * len(pairs)
+        i = 0
+        while i < len(pairs):
+            indexes = range(i, min(i + slice_size, len(pairs)))
+            query = resolve_query.format(pairs=u' UNION ALL '.join(
+                pair_query.format(i=j) for j in indexes))
+            params = {}
+            for j in indexes:
+                params['pageid{0}'.format(j)] = int(pairs[j][0])
+                params['tp_revid{0}'.format(j)] = int(pairs[j][1])
+
+            attempts = 0
+            while attempts < self.db_attempts:
+                try:
+                    self.dbcursor.execute(query, params)
+                    for row in self.dbcursor.fetchall():
+                        if row['recent_id']:
+                            result[row['pair']] = row['recent_id']
+                        else:
+                            # likely a talk page created just before the
+                            # article page, get the first one after instead
+                            logging.warning('failed to get article revision for talk page revision ID {0}, picking first after instead'.format(pairs[row['pair']][1]))
+                            result[row['pair']] = row['next_id']
+                except MySQLdb.OperationalError as e:
+                    attempts += 1
+                    logging.error('unable to execute query to get article revisions')
+                    logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
+                    db.disconnect(self.dbconn, self.dbcursor)
+                    self.db_connect()
+                else:
+                    break # ok, done
+
+            if attempts >= self.db_attempts:
+                logging.error('exhausted query attempts, skipping {0} articles'.format(len(indexes)))
+
+            i += slice_size
+
+        return result
+
+    def clean_article(self, articledata, resolve=True):
         '''
         Using info about a specific article, find out when a given class
         assessment was posted to the talk page, as well as the most recent
         article revision at that time, then fetch quality features for that
         article revision and store it in articledata.
+
+        @param articledata: the article's page ID and class, where we
+                            store what we find
+        @type articledata: dict
+
+        @param resolve: find the article revision, else return True if it
+                        is left for the caller to find, see
+                        resolve_article_revisions()
+        @type resolve: bool
         '''
 
         # Query to get talk page ID and most recent revision of
@@ -291,16 +962,6 @@ class AssessmentFinder:
                              WHERE tp.page_namespace=1
                              AND ap.page_id=%(pageid)s'''
 
-        # Query to get a list of revisions for a given talk page
-        # based on the timestamp of a given article revision.
-        tp_revquery = ur'''SELECT rev_id, rev_timestamp
-                           FROM revision
-                           WHERE rev_page=%(talkpageid)s
-                           AND rev_timestamp < (SELECT rev_timestamp
-                           FROM revision
-                           WHERE rev_id=%(revid)s)
-                           ORDER BY rev_timestamp DESC'''
-
         # Query to get the most recent revision ID of an article
         # at the given time, based on a talk page revision ID
         recent_revquery = ur'''SELECT rev_id, rev_timestamp
@@ -325,44 +986,37 @@ class AssessmentFinder:
                              ORDER BY rev_timestamp ASC
                              LIMIT 1'''
 
-        wp10_scale = {'stub': 0,
-                      'start': 1,
-                      'c': 2,
-                      'b': 3,
-                      'ga': 4,
-                      'a': 5,
-                      'fa': 6}
-
         # map the current class to a number
         start_idx = wp10_scale[articledata['class'].lower()]
         
         logging.info('initial assessment class is {0}'.format(articledata['class']))
 
+        self.connect()
         try:
             self.dbconn.ping()
         except:
             db.disconnect(self.dbconn, self.dbcursor)
-            (self.dbconn, self.dbcursor) = db.connect()
+            self.db_connect()
 
         # Fetch talk page ID, as well as latest revision
         # of both article and talk page
         attempts = 0
         while attempts < self.db_attempts:
             try:
-                
-                self.dbcursor.execute(latest_query,
-                                      {'pageid': articledata['pageid']})
-                for row in self.dbcursor:
-                    articledata['revid'] = row['art_latest']
-                    articledata['talkpageid'] = row['talk_id']
-                    articledata['talkpagerev'] = row['talk_latest']
+                with self.timer.stage('latest_query'):
+                    self.dbcursor.execute(latest_query,
+                                          {'pageid': articledata['pageid']})
+                    for row in self.dbcursor:
+                        articledata['revid'] = row['art_latest']
+                        articledata['talkpageid'] = row['talk_id']
+                        articledata['talkpagerev'] = row['talk_latest']
             except MySQLdb.OperationalError as e:
                 attempts += 1
                 logging.error('unable to execute query to get talk page ID and ltest revision IDs')
                 logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
                 # reconnect
                 db.disconnect(self.dbconn, self.dbcursor)
-                (self.dbconn, self.dbcursor) = db.connect()
+                self.db_connect()
             else:
                 break # ok, done
 
@@ -370,93 +1024,72 @@ class AssessmentFinder:
             logging.error('exhausted query attempts, aborting')
             return
 
-        # get a list of talk page revisions after a given date
-        tp_revs = []
-        attempts = 0
-        while attempts < self.db_attempts:
-            try:
-                
-                self.dbcursor.execute(tp_revquery,
-                                      {'talkpageid': articledata['talkpageid'],
-                                       'revid': articledata['revid']})
-                for row in self.dbcursor:
-                    tp_revs.append(TPRevision(row['rev_id'],
-                                              row['rev_timestamp']))
-                logging.info('found {0} talk page revisions to inspect'.format(len(tp_revs)))
-            except MySQLdb.OperationalError as e:
-                attempts += 1
-                logging.error('unable to execute query to get talk page revisions')
-                logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
-                # reconnect
-                db.disconnect(self.dbconn, self.dbcursor)
-                (self.dbconn, self.dbcursor) = db.connect()
+        # The current class was given in the oldest revision
+        # of the newest intervals with that class
+        def class_start(intervals):
+            prev_tprevid = -1
+            for interval in reversed(intervals):
+                if interval.rank != start_idx:
+                    return (prev_tprevid, True)
+                prev_tprevid = interval.start_rev
+            return (prev_tprevid, False) # ran out of history
+
+        # If we have seen the talk page before, only assess
+        # the revisions made since
+        cached = None
+        if self.timeline_cache:
+            cached = self.timeline_cache.get(articledata['talkpageid'])
+        if cached:
+            (mark, mark_timestamp, complete, intervals) = cached
+            tp_revs = self.get_talk_revisions(articledata['talkpageid'],
+                                              articledata['revid'],
+                                              (mark, mark_timestamp))
+            if tp_revs is None:
+                return
+
+            builder = self.build_timeline(tp_revs, intervals=intervals)
+            (prev_tprevid, found) = class_start(builder.timeline())
+            if found or complete:
+                if tp_revs:
+                    (mark, mark_timestamp) = (tp_revs[-1].id,
+                                              tp_revs[-1].timestamp)
+                self.timeline_cache.put(articledata['talkpageid'],
+                                        mark, mark_timestamp, complete,
+                                        builder.timeline(),
+                                        pageid=articledata['pageid'])
             else:
-                break # ok, done
-
-        if attempts >= self.db_attempts:
-            logging.error('exhausted query attempts, aborting')
-            return
-
-        # If it's empty it means we have the most recent revision,
-        # so we can just keep the data we have and return.
-        if not tp_revs:
-            return
-
-        prev_tprevid = -1
-        i = 0
-        slice_size = 20
-        done = False
-        while i < len(tp_revs) and not done:
-            rev_subset = tp_revs[i:i+slice_size]
-            revisions.get_revisions(self.site, rev_subset)
-
-            for revision in rev_subset:
-                logging.info('assessing talk page revision ID {0}'.format(revision.id))
-                # NOTE: The assessments are at the top of the page,
-                # and the templates are rather small,
-                # so if the page is > 8k, truncate.
-                if not revision.content:
-                    logging.info('revision has no content, skipping')
-                    continue
-
-                if len(revision.content) > 8*1024:
-                    logging.info('revision is {0} bytes, truncating to 8k'.format(len(revision.content)))
-                    revision.content = revision.content[:8*1024]
-                assessments = self.get_assessments(revision.content)
-                cur_idx = []
-                for assessment in assessments:
-                    try:
-                        cur_idx.append(wp10_scale[assessment.rating])
-                    except KeyError:
-                        continue # not a valid assessment
-
-                if not cur_idx:
-                    logging.info('found no assessments in this revision')
-                    if self.is_reverted(revision.id):
-                        logging.info('revision got reverted, continuing...')
-                        continue
-                    else:
-                        # We have found a revision with no assessments
-                        # and it was not reverted, prev_tprevid is the
-                        # talk page revision ID we want to use
-                        done = True
-                        break
-
-                cur_idx = max(cur_idx)
-                logging.info('found assessment with class index {0}'.format(cur_idx))
-                # If we have the same assessment rating
-                # update prev_tprevid because
-                # we then know we have a more recent assessment.
-                if cur_idx == start_idx:
-                    prev_tprevid = revision.id
-                elif cur_idx != start_idx:
-                    # We have found a revision with a lower or higher rating,
-                    # that means prev_tprevid is the talk page revision ID
-                    # we want to use to find the most recent article revision
-                    done = True
-                    break
-            
-            i += slice_size
+                # the cached timeline does not go back far enough
+                logging.info('cached timeline is too short, walking the history again')
+                cached = None
+
+        if not cached:
+            # get the talk page revisions before a given date,
+            # listed as we walk through them
+            tp_revs = self.get_talk_revisions(articledata['talkpageid'],
+                                              articledata['revid'])
+
+            # If it's empty it means we have the most recent revision,
+            # so we can just keep the data we have and return.
+            if not tp_revs:
+                return
+
+            # Walk the talk page history back from the newest revision
+            # until its class is no longer the current one
+            if self.prune:
+                builder = self.find_class_start(tp_revs, start_idx)
+            else:
+                builder = self.build_timeline(
+                    tp_revs, until=lambda interval: interval.rank != start_idx)
+            if tp_revs.failed:
+                return
+            (prev_tprevid, found) = class_start(builder.timeline())
+
+            if self.timeline_cache:
+                # if we ran out of history the timeline is complete
+                self.timeline_cache.put(articledata['talkpageid'],
+                                        tp_revs[0].id, tp_revs[0].timestamp,
+                                        not found, builder.timeline(),
+                                        pageid=articledata['pageid'])
 
         # If prev_tprevid is -1, our existing revision is the valid one
         if prev_tprevid < 0:
@@ -464,6 +1097,8 @@ class AssessmentFinder:
 
         # Update articledata with the found talk page revision ID
         articledata['talkpagerev'] = prev_tprevid
+        if not resolve:
+            return True
 
         # Find the most recent revision of the article at the time
         # of the previous talk page revision ID.
@@ -472,17 +1107,18 @@ class AssessmentFinder:
         attempts = 0
         while attempts < self.db_attempts:
             try:
-                self.dbcursor.execute(recent_revquery,
-                                      {'pageid': articledata['pageid'],
-                                       'tp_revid': prev_tprevid})
-                for row in self.dbcursor:
-                    article_revision = row['rev_id']
+                with self.timer.stage('recent_revquery'):
+                    self.dbcursor.execute(recent_revquery,
+                                          {'pageid': articledata['pageid'],
+                                           'tp_revid': prev_tprevid})
+                    for row in self.dbcursor:
+                        article_revision = row['rev_id']
             except MySQLdb.OperationalError as e:
                 attempts += 1
                 logging.error('unable to execute query to get talk page revisions')
                 logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
                 db.disconnect(self.dbconn, self.dbcursor)
-                (self.dbconn, self.dbcursor) = db.connect()
+                self.db_connect()
             else:
                 break # ok, done
 
@@ -498,17 +1134,18 @@ class AssessmentFinder:
             attempts = 0
             while attempts < self.db_attempts:
                 try:
-                    self.dbcursor.execute(next_revquery,
-                                          {'pageid': articledata['pageid'],
-                                           'tp_revid': prev_tprevid})
-                    for row in self.dbcursor:
-                        article_revision = row['rev_id']
+                    with self.timer.stage('next_revquery'):
+                        self.dbcursor.execute(next_revquery,
+                                              {'pageid': articledata['pageid'],
+                                               'tp_revid': prev_tprevid})
+                        for row in self.dbcursor:
+                            article_revision = row['rev_id']
                 except MySQLdb.Error as e:
                     attempts += 1
                     logging.error('unable to execute query to get talk page revisions')
                     logging.error('MySQLdb error {0}:{1}'.format(e.args[0], e.args[1]))
                     db.disconnect(self.dbconn, self.dbcursor)
-                    (self.dbconn, self.dbcursor) = db.connect()
+                    self.db_connect()
                 else:
                     break # ok, done
 
@@ -533,6 +1170,50 @@ def main():
     cli_parser.add_argument("-v", "--verbose", action="store_true",
                             help="write informational output");
 
+    cli_parser.add_argument("--record", metavar="<recording-path>",
+                            default=None,
+                            help="record all database and API traffic to this file")
+
+    cli_parser.add_argument("--replay", metavar="<recording-path>",
+                            default=None,
+                            help="replay database and API traffic from this recording instead of using the network")
+
+    cli_parser.add_argument("--timing", action="store_true",
+                            help="time each stage of cleaning and print a summary at the end")
+
+    cli_parser.add_argument("--timing-json", metavar="<json-path>",
+                            default=None,
+                            help="write stage timings to this JSON file (implies --timing)")
+
+    cli_parser.add_argument("--slow-queries", metavar="<seconds>",
+                            type=float, default=None,
+                            help="log queries taking at least this many seconds, with their EXPLAIN output")
+
+    cli_parser.add_argument("--api-rate", metavar="<requests-per-second>",
+                            type=float, default=None,
+                            help="maximum rate of API requests (default: {0})".format(apischeduler.api_scheduler.max_rate))
+
+    cli_parser.add_argument("-p", "--processes", type=int, default=None,
+                            help="number of processes to parse talk page revisions in (default: parse in this process)")
+
+    cli_parser.add_argument("--trace", metavar="<trace-path>",
+                            default=None,
+                            help="write a Chrome trace-event file of queries, API requests and articles to this path")
+
+    cli_parser.add_argument("--timeline-cache", metavar="<cache-path>",
+                            default=None,
+                            help="cache talk page timelines in this file, so that pages cleaned before only have their new revisions assessed")
+
+    cli_parser.add_argument("--time-index", metavar="<index-path>",
+                            default=None,
+                            help="after cleaning, write the cached timelines to a class lookup index at this path (requires --timeline-cache)")
+
+    cli_parser.add_argument("--prune", action="store_true",
+                            help="use revision metadata to pick the talk page revisions most likely to change the assessment, and fetch those first")
+
+    cli_parser.add_argument("--bulk-resolve", action="store_true",
+                            help="find the article revisions at the time of the talk page revisions for all articles at once, after cleaning them")
+
     cli_parser.add_argument('input_file', type=str,
                             help='path to input TSV training set file')
     cli_parser.add_argument('output_file', type=str,
@@ -542,8 +1223,47 @@ def main():
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    finder = AssessmentFinder()
+    if args.time_index and not args.timeline_cache:
+        logging.error('--time-index needs a timeline cache to export, use --timeline-cache')
+        return
+
+    timer = None
+    if args.timing or args.timing_json:
+        timer = timing.StageTimer()
+
+    scheduler = None
+    if args.api_rate:
+        scheduler = apischeduler.APIScheduler(rate=args.api_rate)
+
+    tracer = None
+    if args.trace:
+        tracer = tracing.Tracer(args.trace)
+
+    finder = AssessmentFinder(record_file=args.record,
+                              replay_file=args.replay,
+                              timer=timer,
+                              tracer=tracer,
+                              slow_queries=args.slow_queries,
+                              scheduler=scheduler,
+                              processes=args.processes,
+                              timeline_cache=args.timeline_cache,
+                              prune=args.prune,
+                              bulk_resolve=args.bulk_resolve)
     finder.clean_training_set(args.input_file, args.output_file)
+    if args.time_index:
+        finder.timeline_cache.export_index(args.time_index)
+    if finder.dbconn:
+        db.disconnect(finder.dbconn, finder.dbcursor)
+    if finder.parser_pool:
+        finder.parser_pool.close()
+
+    if timer:
+        print(timer.report())
+        if args.timing_json:
+            timer.write_json(args.timing_json)
+
+    if finder.slowlog:
+        print(finder.slowlog.report())
 
     # ok, done
     return
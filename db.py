@@ -5,15 +5,235 @@ Tool Labs database connection library
 '''
 
 import os
+import re
+import time
+import logging
 
 import MySQLdb
 from MySQLdb import cursors
 
+def query_shape(query):
+    '''
+    Get the shape of a query: the query with whitespace normalised and
+    literals and IN-lists of literals replaced by placeholders, so that
+    queries differing only in the values they look for are the same.
+
+    @param query: the SQL query
+    @type query: unicode
+    '''
+    shape = u' '.join(query.split())
+    shape = re.sub(ur'''\bIN\s*\((?:\s*(?:\d+|'[^']*'|"[^"]*")\s*,?)+\)''',
+                   u'IN (...)', shape, flags=re.I)
+    return re.sub(ur'''\b\d+\b|'[^']*'|"[^"]*"''', u'?', shape)
+
+class SlowQueryLog:
+    def __init__(self, threshold=1.0):
+        '''
+        Log of queries that took longer than a given time, see
+        wrap() for timing the queries made through a cursor.
+
+        @param threshold: log queries taking at least this many seconds
+        @type threshold: float
+        '''
+
+        self.threshold = threshold
+
+        # Maps query shape to the EXPLAIN output of its first slow query
+        self.explained = {}
+
+        # Maps query shape to [number of slow queries, total seconds]
+        self.shapes = {}
+
+    def wrap(self, cursor):
+        '''
+        Wrap a cursor so that its slow queries are logged.
+        '''
+        if cursor is None:
+            return None
+        return SlowQueryCursor(cursor, self)
+
+    def log(self, cursor, query, params, seconds):
+        '''
+        Log a slow query, explaining it if it is the first of its shape.
+
+        @param cursor: the cursor that ran the query, its result
+                       must have been read
+        @param query: the SQL query
+        @type query: unicode
+
+        @param params: parameters bound to the query, if any
+        @type params: dict
+
+        @param seconds: time taken to run the query and read its result
+        @type seconds: float
+        '''
+
+        logging.warning(u"Slow query ({0:.2f}s): {1} {2}".format(
+            seconds, u' '.join(query.split()), repr(params)))
+
+        shape = query_shape(query)
+        stats = self.shapes.setdefault(shape, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        if shape in self.explained:
+            return
+
+        try:
+            if params is None:
+                cursor.execute(u'EXPLAIN ' + query)
+            else:
+                cursor.execute(u'EXPLAIN ' + query, params)
+            self.explained[shape] = list(cursor.fetchall())
+        except MySQLdb.Error, e:
+            logging.warning("Unable to explain query: {0}".format(e))
+            self.explained[shape] = []
+
+        for row in self.explained[shape]:
+            logging.warning(u"EXPLAIN: {0}".format(row))
+
+    def report(self):
+        '''
+        Get a printable summary of the slow query shapes, slowest first.
+        '''
+
+        lines = [u'{n} slow queries (over {t}s) of {k} shapes'.format(
+            n=sum(count for (count, seconds) in self.shapes.values()),
+            t=self.threshold, k=len(self.shapes))]
+        for (shape, (count, seconds)) in sorted(self.shapes.items(),
+                                                 key=lambda item: -item[1][1]):
+            lines.append(u'{0:>8.2f}s {1:>6}x {2}'.format(seconds, count, shape))
+        return u'\n'.join(lines)
+
+class SlowQueryCursor:
+    '''
+    Wraps a database cursor, timing each query and passing the slow
+    ones to a SlowQueryLog.
+
+    A query's time includes reading its result, which for the
+    unbuffered cursors we use is where most of the time goes, so a
+    query is checked when the next one is made or the cursor is closed.
+    '''
+
+    def __init__(self, cursor, slowlog):
+        self.cursor = cursor
+        self.slowlog = slowlog
+
+        # The current query, its parameters, and time spent on it
+        self.query = None
+        self.params = None
+        self.seconds = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.seconds += time.time() - start
+
+    def _finish(self):
+        if self.query is not None and self.seconds >= self.slowlog.threshold:
+            # read any rows left unread, the EXPLAIN can't run before
+            self.cursor.fetchall()
+            self.slowlog.log(self.cursor, self.query, self.params,
+                             self.seconds)
+        self.query = None
+
+    def execute(self, query, params=None):
+        self._finish()
+        self.query = query
+        self.params = params
+        self.seconds = 0.0
+        if params is None:
+            return self._timed(self.cursor.execute, query)
+        return self._timed(self.cursor.execute, query, params)
+
+    def fetchone(self):
+        return self._timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        self._finish()
+        self.cursor.close()
+
+class ReplicaLag:
+    def __init__(self, shard='s1', interval=60.0):
+        '''
+        Reader of the replica's lag from the heartbeat table, reading it
+        at most once per interval so that it can be asked after every
+        batch of queries.
+
+        @param shard: database shard (section) of the wiki, "s1" for enwiki
+        @type shard: str
+
+        @param interval: seconds to keep a reading for
+        @type interval: float
+        '''
+
+        self.shard = shard
+        self.interval = interval
+
+        self.query = u'''SELECT lag
+                         FROM heartbeat_p.heartbeat
+                         WHERE shard=%(shard)s'''
+
+        # Last reading and when it was taken, and whether
+        # the heartbeat table can be read at all
+        self.lag = None
+        self.updated = 0.0
+        self.available = True
+
+    def get(self, dbcursor):
+        '''
+        Get the replica's lag in seconds, or None if it is not known.
+        The cursor's result must have been read.
+
+        @param dbcursor: database cursor to use for the query
+        @type dbcursor: MySQLdb.cursors.SSDictCursor
+        '''
+
+        if not self.available:
+            return None
+
+        now = time.time()
+        if now - self.updated < self.interval:
+            return self.lag
+        self.updated = now
+
+        try:
+            dbcursor.execute(self.query, {'shard': self.shard})
+            rows = dbcursor.fetchall()
+        except MySQLdb.Error, e:
+            logging.warning("Unable to read replica lag, not adapting to it: {0}".format(e))
+            self.available = False
+            self.lag = None
+            return None
+
+        self.lag = None
+        if rows:
+            self.lag = float(rows[0]['lag'])
+        return self.lag
+
 def connect(dbhost='enwiki.labsdb',
             dbname='enwiki_p',
-            dbconf='~/replica.my.cnf'):
+            dbconf='~/replica.my.cnf',
+            slowlog=None):
     '''
     Open the database connection.
+
+    @param slowlog: log of slow queries to time the cursor's queries
+                    with, if any
+    @type slowlog: SlowQueryLog
     '''
     try:
         dbconn = MySQLdb.connect(host=dbhost,
@@ -22,6 +242,8 @@ def connect(dbhost='enwiki.labsdb',
                                  read_default_file=os.path.expanduser(dbconf))
         # Create an SSDictCursor, standard fare.
         dbcursor = dbconn.cursor(cursors.SSDictCursor)
+        if slowlog:
+            dbcursor = slowlog.wrap(dbcursor)
         return (dbconn, dbcursor)
     except MySQLdb.Error, e:
         logging.error("Unable to connect to database: {code} {explain}".format(code=e.args[0], explain=e.args[1]))
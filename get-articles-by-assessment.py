@@ -22,16 +22,35 @@ import os
 import re
 import codecs
 import random
+import time
 
 import MySQLdb
 from MySQLdb import cursors
 
 import logging
 
+import db
+from catcache import CategoryCache
+from redirects import RedirectResolver
+from batching import AdaptiveSlice
+import output
+import tracing
+import memprofile
+from classindex import IndexWriter
+from ranks import ClassRanks
+
 class ArticleSampler:
     def __init__(self, sampleConfigFile=None, outputFilename=None,
                  sampleTestSet=False,
-                 cutoffDate=None):
+                 cutoffDate=None,
+                 categoryCacheFile=None,
+                 redirectMapFile=None,
+                 outputFormat='tsv',
+                 indexFilename=None,
+                 traceFilename=None,
+                 slowQueryThreshold=None,
+                 profileMemory=False,
+                 deepMemorySizes=False):
 
         self.dbHost = 'enwiki.labsdb'
         self.dbName = 'enwiki_p'
@@ -45,21 +64,59 @@ class ArticleSampler:
         # Do we only accept articles created before a given date?
         self.cutoffDate = cutoffDate
 
-        # Set of page IDs for articles we've already retrieved
-        self.alreadySampled = set()
-        
         # Mapping used for setting sort values, used for prioritising
         # article selection.
         self.classes = ['FA', 'A',
                         'GA', 'B',
                         'C', 'Start', 'Stub']
 
+        # Highest assessment class of the articles we've retrieved
+        self.classRanks = ClassRanks(self.classes)
+
         self.outputFilename = "~/all-assessed-articles";
         if outputFilename:
             self.outputFilename = outputFilename;
 
+        # Format of the output file(s), one of output.FORMATS
+        self.outputFormat = outputFormat;
+
+        # Path to the page ID to class lookup index, if any
+        self.indexFilename = indexFilename;
+
         self.seenCount = 0;
 
+        # Disk cache of the assessment category trees, if any
+        self.catCache = None;
+        if categoryCacheFile:
+            self.catCache = CategoryCache(categoryCacheFile);
+
+        # Redirect targets, shared by all traversals and
+        # optionally stored between runs
+        self.redirectResolver = RedirectResolver(redirectMapFile);
+
+        # Batch sizes of the traversal's IN-list queries, adapted
+        # to how fast the replica answers them
+        self.subCatSlices = AdaptiveSlice(size=100);
+        self.articleSlices = AdaptiveSlice(size=100);
+
+        # Replica lag, which also shrinks the batches
+        self.replicaLag = db.ReplicaLag();
+
+        # Tracer recording queries and traversal steps, if asked to
+        self.tracer = tracing.NullTracer();
+        if traceFilename:
+            self.tracer = tracing.Tracer(traceFilename);
+
+        # Log of queries slower than the threshold, if any
+        self.slowQueryLog = None;
+        if slowQueryThreshold is not None:
+            self.slowQueryLog = db.SlowQueryLog(slowQueryThreshold);
+
+        # Memory profiler reporting on each phase of the traversal, if any
+        self.memProfiler = memprofile.NullProfiler();
+        if profileMemory:
+            self.memProfiler = memprofile.MemoryProfiler(deep=deepMemorySizes);
+
     def connect(self):
         '''
         Open the database connection.
@@ -71,6 +128,9 @@ class ArticleSampler:
                                           read_default_file=os.path.expanduser(self.dbConf));
             # Create an SSDictCursor, standard fare.
             self.dbCursor = self.dbConn.cursor(cursors.SSDictCursor);
+            if self.slowQueryLog:
+                self.dbCursor = self.slowQueryLog.wrap(self.dbCursor);
+            self.dbCursor = self.tracer.wrap_cursor(self.dbCursor);
         except MySQLdb.Error, e:
             logging.error("Unable to connect to database: {code} {explain}".format(code=e.args[0], explain=e.args[1]));
             self.dbConn = None;
@@ -182,17 +242,19 @@ class ArticleSampler:
                                              AND p.page_title LIKE "%%by_quality")''';
         
         # Query to grab sub-categories of a given set of categories where
-        # the category title matches a given pattern
-        validSubCatQuery = ur'''SELECT p.page_id, p.page_is_redirect
-                                FROM categorylinks cl
+        # the category title matches a given pattern, together with
+        # the page ID of the category they were found in
+        validSubCatQuery = ur'''SELECT parent.page_id AS parent_id,
+                                       p.page_id, p.page_is_redirect
+                                FROM page parent
+                                JOIN categorylinks cl
+                                ON cl.cl_to=parent.page_title
                                 JOIN page p
                                 ON cl.cl_from=p.page_id
-                                WHERE p.page_namespace=14
-                                AND p.page_title LIKE "{classmatch}"
-                                AND cl.cl_to IN (
-                                    SELECT page_title
-                                    FROM page
-                                    WHERE page_id IN ({pageidlist}))''';
+                                WHERE parent.page_namespace=14
+                                AND parent.page_id IN ({pageidlist})
+                                AND p.page_namespace=14
+                                AND p.page_title LIKE "{classmatch}"''';
 
         # Query to get all pages from a given set of categories
         getArticlesQuery = ur'''SELECT p2.page_title, p2.page_id,
@@ -208,16 +270,6 @@ class ArticleSampler:
                                    FROM page
                                    WHERE page_id IN ({pageidlist}))''';
 
-        # Query to resolve redirects that go to a given namespace
-        resolveRedirectQuery = ur"""SELECT page_title, page_id,
-                                           page_is_redirect
-                                    FROM redirect
-                                    JOIN page
-                                    ON (rd_namespace=page_namespace
-                                    AND rd_title=page_title)
-                                    WHERE rd_from IN ({pageidlist})
-                                    AND page_namespace={ns}""";
-
         getPagesFromCategoryQuery = ur"""SELECT cat_pages
                                          FROM category
                                          WHERE cat_id IN ({pageidlist})""";
@@ -227,6 +279,7 @@ class ArticleSampler:
                          WHERE cl_to="All_article_disambiguation_pages"'''
 
         logging.info("Getting {aClass}-Class articles".format(aClass=assessmentClass));
+        self.memProfiler.start(assessmentClass);
 
         # Find all matching sub-categories
         allSubCats = []
@@ -243,52 +296,86 @@ class ArticleSampler:
         seenCats = set();
         moreSubCats = set();
 
+        # Check the cached category trees against the category table,
+        # categories that have changed since are walked again.
+        if self.catCache:
+            self.catCache.validate(self.dbCursor);
+
         logging.info("Looking for sub*-categories...");
 
         i = 0;
-        sliceSize = 100;
         while i < len(candidateCats):
+            sliceSize = self.subCatSlices.size;
             logging.info("Have {n} candidate categories, taking slice {j}:{k}".format(n=len(candidateCats), j=i, k=i+sliceSize));
 
             curSlice = candidateCats[i:i+sliceSize];
             seenCats.update(curSlice);
-
-            redirects = [];
-
-            self.dbCursor.execute(validSubCatQuery.format(pageidlist=",".join(candidateCats[i:i+sliceSize]), classmatch=classMatch));
-            for row in self.dbCursor.fetchall():
-                pageId = str(row['page_id']);
-                if not pageId in seenCats:
-                    seenCats.add(pageId);
+            sliceSpan = self.tracer.begin('subcategory slice', 'traversal',
+                                          assessmentClass=assessmentClass,
+                                          start=i, size=len(curSlice));
+
+            # Map each category in the slice to its valid child categories,
+            # using the cache where possible.
+            childCats = {};
+            uncachedCats = [];
+            for catId in curSlice:
+                children = None;
+                if self.catCache:
+                    children = self.catCache.children(assessmentClass, catId);
+                if children is None:
+                    childCats[catId] = [];
+                    uncachedCats.append(catId);
+                else:
+                    childCats[catId] = children;
+
+            if uncachedCats:
+                # Read the counts before walking, so that any change made
+                # while we walk makes the category stale next time.
+                if self.catCache:
+                    catCounts = self.catCache.get_counts(self.dbCursor, uncachedCats);
+
+                # Maps redirect page ID to the categories it was found in
+                redirects = {};
+
+                queryStart = time.time();
+                self.dbCursor.execute(validSubCatQuery.format(pageidlist=",".join(uncachedCats), classmatch=classMatch));
+                rows = self.dbCursor.fetchall();
+                self.subCatSlices.record(len(uncachedCats), len(rows),
+                                         time.time() - queryStart,
+                                         lag=self.replicaLag.get(self.dbCursor));
+                for row in rows:
+                    pageId = str(row['page_id']);
+                    parentId = str(row['parent_id']);
                     if row['page_is_redirect']:
                         # add to redirects to check
-                        redirects.append(pageId);
+                        redirects.setdefault(pageId, []).append(parentId);
                     else:
+                        childCats[parentId].append(pageId);
+
+                # Resolve redirects
+                if redirects:
+                    logging.info("Resolving {n} redirects".format(n=len(redirects)));
+
+                    resolved = self.redirectResolver.resolve(self.dbCursor, redirects.keys(), 14);
+                    for (rdFrom, (pageId, pageTitle)) in resolved.iteritems():
+                        for parentId in redirects[str(rdFrom)]:
+                            childCats[parentId].append(str(pageId));
+
+                if self.catCache:
+                    for catId in uncachedCats:
+                        self.catCache.store(assessmentClass, catId,
+                                            childCats[catId], catCounts[catId]);
+
+            for catId in curSlice:
+                for pageId in childCats[catId]:
+                    if not pageId in seenCats:
                         # Valid category, add to candidate for further inspection
                         # and to list of categories to fetch articles from
+                        seenCats.add(pageId);
                         moreSubCats.add(pageId);
                         candidateCats.append(pageId);
 
-            # Resolve redirects
-            if redirects:
-                logging.info("Resolving {n} redirects".format(n=len(redirects)));
-
-                j = 0;
-                while j < len(redirects):
-                    self.dbCursor.execute(resolveRedirectQuery.format(ns=14,
-                                                                      pageidlist=",".join(redirects[j:j+sliceSize])));
-                    for row in self.dbCursor.fetchall():
-                        if not row['page_is_redirect']:
-                            pageId = str(row['page_id']);
-                            if not row in seenCats:
-                                # Valid category, add to candidate for further inspection
-                                # and to list of categories to fetch articles from
-                                seenCats.add(pageId);
-                                moreSubCats.add(pageId);
-                                candidateCats.append(pageId);
-
-                    # OK, move redirects forward
-                    j += sliceSize
+            self.tracer.end(sliceSpan, uncached=len(uncachedCats));
 
             # OK, move categories forward
             i += sliceSize;
@@ -300,15 +387,33 @@ class ArticleSampler:
 
         logging.info("Now have {n} categories to grab articles from".format(n=len(allSubCats)));
 
+        if self.catCache:
+            self.catCache.save();
+            logging.info("Category table lists {n} pages in these categories".format(n=self.catCache.page_count(assessmentClass, allSubCats)));
+
+        self.memProfiler.phase('subcategory discovery',
+                               allSubCats=allSubCats,
+                               candidateCats=candidateCats,
+                               seenCats=seenCats,
+                               moreSubCats=moreSubCats);
+
         # Grab all articles from them, resolving redirects as necessary
         allArticles = set();
         redirects = set();
 
         i = 0;
-        sliceSize = 100;
         while i < len(allSubCats):
+            sliceSize = self.articleSlices.size;
+            sliceSpan = self.tracer.begin('article slice', 'traversal',
+                                          assessmentClass=assessmentClass,
+                                          start=i);
+            queryStart = time.time();
             self.dbCursor.execute(getArticlesQuery.format(pageidlist=",".join(allSubCats[i:i+sliceSize]), ns=0));
-            for row in self.dbCursor.fetchall():
+            rows = self.dbCursor.fetchall();
+            self.articleSlices.record(len(allSubCats[i:i+sliceSize]), len(rows),
+                                      time.time() - queryStart,
+                                      lag=self.replicaLag.get(self.dbCursor));
+            for row in rows:
                 # List or disambiguation? Then skip...
                 pageTitle = unicode(row['page_title'], 'utf-8', errors='strict')
                 if listRe.match(pageTitle) \
@@ -321,30 +426,31 @@ class ArticleSampler:
                 else:
                     allArticles.add(row['page_id'])
 
+            self.tracer.end(sliceSpan);
+
             i += sliceSize;
                     
         logging.info("Found {n} articles and {m} redirects.".format(n=len(allArticles),
                                                                     m=len(redirects)));
+        self.memProfiler.phase('membership fetch',
+                               allArticles=allArticles,
+                               redirects=redirects);
 
         # resolve single redirects
-        i = 0;
-        sliceSize = 100;
-        redirects = [str(pageid) for pageid in redirects];
-        while i < len(redirects):
-            self.dbCursor.execute(resolveRedirectQuery.format(pageidlist=",".join(redirects[i:i+sliceSize]), ns=0));
-            for row in self.dbCursor.fetchall():
-                # List or disambiguation? Then skip...
-                pageTitle = unicode(row['page_title'], 'utf-8', errors='strict');
-                if listRe.match(pageTitle) \
-                        or disambigRe.search(pageTitle):
-                    continue;
-
-                if not row['page_is_redirect']:
-                    allArticles.add(row['page_id']);
+        resolved = self.redirectResolver.resolve(self.dbCursor, redirects, 0);
+        for (pageId, pageTitle) in resolved.itervalues():
+            # List or disambiguation? Then skip...
+            if listRe.match(pageTitle) \
+                    or disambigRe.search(pageTitle):
+                continue;
 
-            i += sliceSize;
+            allArticles.add(pageId);
 
         logging.info("Found {n} articles before checking disambiguations".format(n=len(allArticles)));
+        self.memProfiler.phase('redirect resolution',
+                               allArticles=allArticles,
+                               resolved=resolved,
+                               redirectMap=self.redirectResolver.targets);
 
         # logging.info("Checking article count using the category table");
 
@@ -366,6 +472,9 @@ class ArticleSampler:
         for row in self.dbCursor:
             dabs.add(row['cl_from'])
         allArticles -= dabs
+        self.memProfiler.phase('disambiguation removal',
+                               allArticles=allArticles,
+                               dabs=dabs)
 
         logging.info("Found {n} articles in total".format(n=len(allArticles)));
 
@@ -459,15 +568,6 @@ class ArticleSampler:
                               WHERE p.page_namespace=14
                               AND cl.cl_to=%(catname)s""";
 
-        # Query to resolve redirects that stay within the Main namespace
-        resolveRedirectQuery = ur"""SELECT page_id, page_is_redirect
-                                    FROM redirect
-                                    JOIN page
-                                    ON (rd_namespace=page_namespace
-                                    AND rd_title=page_title)
-                                    WHERE rd_from IN ({pageidlist})
-                                    AND page_namespace=0""";
-
         # for easy FIFO queues, we use deque;
         from collections import deque;
 
@@ -499,15 +599,9 @@ class ArticleSampler:
         # logging.info("Attempting to resolve {n} redirects".format(n=len(redirects)));
 
         # resolve single redirects
-        i = 0;
-        sliceSize = 100;
-        while i < len(redirects):
-            self.dbCursor.execute(resolveRedirectQuery.format(pageidlist=",".join(redirects[i:i+sliceSize])));
-            for row in self.dbCursor.fetchall():
-                if not row['page_is_redirect']:
-                    foundArticles.add(row['page_id']);
-
-            i += sliceSize;
+        resolved = self.redirectResolver.resolve(self.dbCursor, redirects, 0);
+        for (pageId, pageTitle) in resolved.itervalues():
+            foundArticles.add(pageId);
 
         redirects = None; # no longer needed
 
@@ -522,6 +616,8 @@ class ArticleSampler:
         while len(catQueue) > 0:
             # grab the current category
             curCategory = catQueue.popleft();
+            catSpan = self.tracer.begin('category', 'traversal',
+                                        categoryName=curCategory);
 
             # sub any spaces with underscores for queries
             catName = re.sub(" ", "_", curCategory);
@@ -543,15 +639,9 @@ class ArticleSampler:
                     foundArticles.add(row['page_id']);
 
             # resolve single redirects
-            i = 0;
-            sliceSize = 100;
-            while i < len(redirects):
-                self.dbCursor.execute(resolveRedirectQuery.format(pageidlist=",".join(redirects[i:i+sliceSize])));
-                for row in self.dbCursor.fetchall():
-                    if not row['page_is_redirect']:
-                        foundArticles.add(row['page_id']);
-
-                i += sliceSize;
+            resolved = self.redirectResolver.resolve(self.dbCursor, redirects, 0);
+            for (pageId, pageTitle) in resolved.itervalues():
+                foundArticles.add(pageId);
 
             redirects = None; # no longer needed
 
@@ -565,6 +655,8 @@ class ArticleSampler:
                     catQueue.append(subCatName);
                     seenCats.add(subCatName);
 
+            self.tracer.end(catSpan, articles=len(foundArticles));
+
             logging.info("Found {n} articles, category queue length is {k}".format(n=len(foundArticles), k=len(catQueue)));
 
         return foundArticles;
@@ -574,25 +666,38 @@ class ArticleSampler:
         Retrieve assessment class articles.
         """
         
-        with codecs.open(os.path.expanduser(self.outputFilename), 'w+', 'utf-8') as outFile:
-            outFile.write("pageid\tassessment_class\n"); # write header
+        # for each category...
+        for assessment_class in self.classes:
+            # grab all articles
+            with self.tracer.span('class', 'traversal', assessmentClass=assessment_class):
+                classArticles = self.getAssessmentClassArticles(assessmentClass=assessment_class)
+
+            # Record the articles' class.  The rank array keeps the
+            # _highest_ assessment an article might have, so that it is
+            # only retrieved from that class regardless of the order in
+            # which classes are traversed.
+            self.classRanks.add(classArticles, assessment_class)
+            classArticles = None # no longer needed
 
-            # for each category...
+        logging.info("Writing {n} articles".format(n=len(self.classRanks)))
+
+        # Rows are grouped by class, from the highest to the lowest
+        columns = [('pageid', 'int64'), ('assessment_class', 'class')]
+        with output.open_writer(self.outputFilename, columns, self.classes,
+                                self.outputFormat) as outFile:
             for assessment_class in self.classes:
-                # grab all articles
-                classArticles = self.getAssessmentClassArticles(assessmentClass=assessment_class)
-                # remove any articles that have already been retrieved
-                classArticles -= self.alreadySampled
+                for pageid in self.classRanks.pages(assessment_class):
+                    outFile.write((pageid, assessment_class))
 
-                # Add the remaining articles to the set of already seen articles.
-                # This is done to assure that an article is only sampled from
-                # the _highest_ assessment it might have.  Otherwise we could
-                # first have an article as an A-class candidate, then later have
-                # it as a B-class candidate, because we'd see it again.
-                self.alreadySampled |= classArticles
+        if self.indexFilename:
+            logging.info("Writing class lookup index to {0}".format(self.indexFilename))
+            with IndexWriter(self.indexFilename, self.classes) as indexFile:
+                for row in self.classRanks.items():
+                    indexFile.write(row)
 
-                for pageid in classArticles:
-                    outFile.write("{pageid}\t{classname}\n".format(classname=assessment_class, pageid=pageid));
+        logging.info("Resolved {n} redirects, {k} lookups answered from the redirect map".format(n=self.redirectResolver.n_queried, k=self.redirectResolver.n_hits));
+        self.redirectResolver.save();
+        self.tracer.save();
 
         logging.info("All done!");
         return;
@@ -611,12 +716,54 @@ def main():
                             default=None,
                             help="path to output file");
 
+    cli_parser.add_argument("--category-cache", metavar="<cache-path>",
+                            default=None,
+                            help="path to category tree cache file (default: no caching)");
+
+    cli_parser.add_argument("--redirect-map", metavar="<map-path>",
+                            default=None,
+                            help="path to file storing resolved redirects between runs (default: not stored)");
+
+    cli_parser.add_argument("-f", "--format", choices=output.FORMATS,
+                            default='tsv',
+                            help="output file format (default: tsv)");
+
+    cli_parser.add_argument("--index", metavar="<index-path>",
+                            default=None,
+                            help="also write a memory-mappable page ID to class index (see classindex.py)");
+
+    cli_parser.add_argument("--slow-queries", metavar="<seconds>",
+                            type=float, default=None,
+                            help="log queries taking at least this many seconds, with their EXPLAIN output");
+
+    cli_parser.add_argument("--profile-memory", action="store_true",
+                            help="report memory use at each phase of the traversal (uses tracemalloc if available)");
+
+    cli_parser.add_argument("--deep-sizes", action="store_true",
+                            help="with --profile-memory, measure structures by walking all of them rather than a sample (slow)");
+
+    cli_parser.add_argument("--trace", metavar="<trace-path>",
+                            default=None,
+                            help="write a Chrome trace-event file of queries and traversal steps to this path");
+
     args = cli_parser.parse_args();
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG);
 
-    mySampler = ArticleSampler(outputFilename=args.outputfile)
+    if args.format != 'tsv' and output.pyarrow is None:
+        logging.error("pyarrow is required to write {0} output, unable to continue".format(args.format));
+        return;
+
+    mySampler = ArticleSampler(outputFilename=args.outputfile,
+                               categoryCacheFile=args.category_cache,
+                               redirectMapFile=args.redirect_map,
+                               outputFormat=args.format,
+                               indexFilename=args.index,
+                               traceFilename=args.trace,
+                               slowQueryThreshold=args.slow_queries,
+                               profileMemory=args.profile_memory,
+                               deepMemorySizes=args.deep_sizes)
     if not mySampler.connect():
         logging.error("Couldn't connect to database server, unable to continue");
         return;
@@ -625,6 +772,12 @@ def main():
 
     mySampler.disconnect();
 
+    if mySampler.slowQueryLog:
+        print(mySampler.slowQueryLog.report());
+
+    if args.profile_memory:
+        print(mySampler.memProfiler.report());
+
     # ok, done
     return;
 
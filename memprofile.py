@@ -0,0 +1,220 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Memory profiling at phase boundaries, for finding out which structure
+is to blame when extraction runs out of memory.
+
+MemoryProfiler takes a tracemalloc snapshot at the start of a run and
+at the end of each of its phases, recording how much was allocated in
+the phase, the peak, the source lines responsible, and the length and
+size of the structures the caller names.  Sizes are estimated from a
+sample of the elements, so that measuring a structure takes little time
+and memory however large it is; walking all of it is optional.  Without
+tracemalloc (it is part of the
+standard library from Python 3.4, and available as pytracemalloc for
+older versions) only the structure sizes and the process' maximum
+resident set size are recorded.
+
+NullProfiler has the same interface and does nothing.
+'''
+
+import sys
+import logging
+import resource
+import itertools
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def deep_size(obj):
+    '''
+    Get the approximate size in bytes of a structure, including the
+    contents of any lists, tuples, sets and dicts it is built from.
+    This walks the whole structure.
+
+    @param obj: the structure
+    '''
+
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+def structure_size(obj, sample=100, deep=False):
+    '''
+    Get the length of a structure, or None if it has none, and its
+    approximate size in bytes.  The size is that of the container plus
+    its length times the mean size of a sample of its elements (or
+    items, for dicts), each measured with deep_size().
+
+    @param obj: the structure
+
+    @param sample: number of elements to measure
+    @type sample: int
+
+    @param deep: walk all of the structure with deep_size() instead
+    @type deep: bool
+    '''
+
+    if not isinstance(obj, (dict, list, tuple, set, frozenset)):
+        return (None, deep_size(obj))
+
+    length = len(obj)
+    if deep:
+        return (length, deep_size(obj))
+    if not length:
+        return (length, sys.getsizeof(obj))
+
+    if isinstance(obj, dict):
+        sizes = [deep_size(key) + deep_size(value)
+                 for (key, value) in itertools.islice(obj.iteritems(), sample)]
+    elif isinstance(obj, (list, tuple)):
+        # spread out, as elements added later may differ
+        sizes = [deep_size(element)
+                 for element in obj[::max(1, length // sample)][:sample]]
+    else:
+        sizes = [deep_size(element)
+                 for element in itertools.islice(obj, sample)]
+    return (length, sys.getsizeof(obj) + length * sum(sizes) // len(sizes))
+
+def take_snapshot():
+    '''
+    Take a tracemalloc snapshot, leaving out the allocations made by
+    tracemalloc and the profiler.
+    '''
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__),
+         tracemalloc.Filter(False, __file__.rstrip('co'))])
+
+class MemoryProfiler:
+    def __init__(self, top=5, frames=1, deep=False):
+        '''
+        Set up the profiler, tracing allocations if tracemalloc
+        is available.
+
+        @param top: number of allocation sites to list per phase
+        @type top: int
+
+        @param frames: number of frames to keep in allocation tracebacks
+        @type frames: int
+
+        @param deep: walk all of each structure to measure it,
+                     rather than a sample of its elements
+        @type deep: bool
+        '''
+
+        self.top = top
+        self.deep = deep
+        if tracemalloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+        else:
+            logging.warning("tracemalloc is not available, only reporting structure sizes")
+
+        # Label of the current run, e.g. the assessment class,
+        # and the snapshot taken at the end of the previous phase
+        self.label = None
+        self.snapshot = None
+
+        # One dict per phase with its label, name, allocated and peak
+        # bytes, top allocation sites, and structure sizes
+        self.phases = []
+
+    def start(self, label):
+        '''
+        Start a run, the phases that follow are reported under its label.
+
+        @param label: label of the run
+        @type label: str
+        '''
+
+        self.label = label
+        if tracemalloc:
+            self.snapshot = take_snapshot()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+    def phase(self, name, **structures):
+        '''
+        Mark the end of a phase.
+
+        @param name: name of the phase
+        @type name: str
+
+        @param structures: structures to report the length and size of,
+                           by name
+        '''
+
+        result = {'label': self.label,
+                  'phase': name,
+                  'allocated': None,
+                  'peak': None,
+                  'sites': [],
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+        # Measure the phase before measuring the structures,
+        # which allocates memory of its own
+        if tracemalloc:
+            result['peak'] = tracemalloc.get_traced_memory()[1]
+            snapshot = take_snapshot()
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+            result['allocated'] = sum(stat.size_diff for stat in stats)
+            result['sites'] = [(str(stat.traceback), stat.size_diff)
+                               for stat in stats[:self.top]]
+            self.snapshot = snapshot
+
+        result['structures'] = dict((key, structure_size(value, deep=self.deep))
+                                    for (key, value) in structures.items())
+
+        if tracemalloc and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        self.phases.append(result)
+
+    def report(self):
+        '''
+        Get a printable report of the phases.
+        '''
+
+        lines = []
+        for result in self.phases:
+            line = u'{label} {phase}:'.format(**result)
+            if result['allocated'] is not None:
+                line += u' allocated {0:.1f} MB, peak {1:.1f} MB,'.format(
+                    result['allocated'] / 1048576.0,
+                    result['peak'] / 1048576.0)
+            line += u' max RSS {0:.1f} MB'.format(result['max_rss_kb'] / 1024.0)
+            lines.append(line)
+
+            for (key, (length, size)) in sorted(result['structures'].items(),
+                                                key=lambda item: -item[1][1]):
+                if length is None:
+                    length = u''
+                lines.append(u'  {0:<20} {1:>10} {2:>10.1f} MB'.format(key, length, size / 1048576.0))
+            for (site, size) in result['sites']:
+                lines.append(u'  {0:>+10.1f} MB at {1}'.format(size / 1048576.0, site))
+        return u'\n'.join(lines)
+
+class NullProfiler:
+    '''
+    Profiler that does nothing, used when profiling is switched off.
+    '''
+
+    def start(self, label):
+        pass
+
+    def phase(self, name, **structures):
+        pass
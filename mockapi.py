@@ -0,0 +1,339 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Local mock of the MediaWiki API, used for benchmarking revision fetches.
+
+Serves action=query&prop=revisions from a fixture corpus of revisions,
+with configurable latency, query-continue truncation and error
+injection, plus enough siteinfo for pywikibot to talk to it.  Use
+mock_site() to get a pywikibot site pointed at a running server.
+
+The fixture corpus is a file with one JSON object per line, holding
+the revision's "revid", "pageid", "title", "timestamp" and "content".
+'''
+
+import json
+import time
+import random
+import logging
+import urlparse
+import threading
+import BaseHTTPServer
+
+class MockAPIServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, corpus, host='localhost', port=0, latency=0.0,
+                 revision_latency=0.0, max_content=50, error_rate=0.0,
+                 error_code='maxlag', seed=0):
+        '''
+        Set up the server, call start() to serve requests
+        in a background thread.
+
+        @param corpus: maps revision ID (int) to a dict with the
+                       revision's pageid, title, timestamp and content
+        @type corpus: dict
+
+        @param host: host name to listen on
+        @type host: str
+
+        @param port: port to listen on, 0 picks a free port
+        @type port: int
+
+        @param latency: seconds to wait before answering each request
+        @type latency: float
+
+        @param revision_latency: additional seconds to wait for each
+                                 revision whose content is returned
+        @type revision_latency: float
+
+        @param max_content: maximum number of revisions returned with
+                            content per request, the rest is left for
+                            a query-continue
+        @type max_content: int
+
+        @param error_rate: probability that a request fails
+        @type error_rate: float
+
+        @param error_code: how requests fail: "maxlag" or another API
+                           error code, or "http503" for a server error
+        @type error_code: str
+
+        @param seed: seed for the random number generator
+        @type seed: int
+        '''
+
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           MockAPIHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.revision_latency = revision_latency
+        self.max_content = max_content
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.rng = random.Random(seed)
+        self.thread = None
+
+        # Number of requests served, revisions returned with content,
+        # and errors injected
+        self.n_requests = 0
+        self.n_revisions = 0
+        self.n_errors = 0
+
+    @property
+    def url(self):
+        '''
+        URL of the API endpoint.
+        '''
+        return 'http://{0}:{1}/w/api.php'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class MockAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        self.handle_api(urlparse.parse_qs(query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        self.handle_api(urlparse.parse_qs(self.rfile.read(length)))
+
+    def send_json(self, data, status=200, headers={}):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_api(self, params):
+        server = self.server
+        params = dict((key, values[-1]) for (key, values) in params.items())
+        server.n_requests += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and server.rng.random() < server.error_rate:
+            server.n_errors += 1
+            if server.error_code == 'http503':
+                self.send_json({}, status=503, headers={'Retry-After': '1'})
+            else:
+                self.send_json({'error': {'code': server.error_code,
+                                          'info': 'Injected error'}},
+                               headers={'Retry-After': '1'})
+            return
+
+        action = params.get('action')
+        if action != 'query':
+            self.send_json({'error': {'code': 'unknown_action',
+                                      'info': 'Unsupported action {0}'.format(action)}})
+            return
+
+        result = {'query': {}}
+        meta = params.get('meta', '').split('|')
+        if 'siteinfo' in meta:
+            result['query'].update(siteinfo(self.server,
+                                            params.get('siprop', 'general')))
+        if 'userinfo' in meta:
+            result['query']['userinfo'] = {'id': 0, 'name': '127.0.0.1',
+                                           'anon': '', 'groups': ['*'],
+                                           'rights': ['read']}
+        if 'revids' in params:
+            self.query_revisions(params, result)
+
+        self.send_json(result)
+
+    def query_revisions(self, params, result):
+        '''
+        Answer a prop=revisions query for the given revision IDs,
+        returning content for at most max_content revisions.
+        '''
+
+        server = self.server
+        revids = sorted(int(revid) for revid in params['revids'].split('|'))
+        if 'rvcontinue' in params:
+            start = int(params['rvcontinue'].split('|')[-1])
+            revids = [revid for revid in revids if revid >= start]
+
+        with_content = 'content' in params.get('rvprop', '').split('|')
+
+        pages = {}
+        badrevids = {}
+        n_content = 0
+        for revid in revids:
+            revision = server.corpus.get(revid)
+            if revision is None:
+                badrevids[str(revid)] = {'revid': revid}
+                continue
+
+            if with_content and n_content >= server.max_content:
+                result['query-continue'] = {
+                    'revisions': {'rvcontinue': str(revid)}}
+                break
+
+            pageid = str(revision['pageid'])
+            page = pages.setdefault(pageid, {'pageid': revision['pageid'],
+                                             'ns': 1,
+                                             'title': revision['title'],
+                                             'revisions': []})
+            revdata = {'revid': revid,
+                       'parentid': 0,
+                       'timestamp': revision['timestamp'],
+                       'size': len(revision['content'])}
+            if with_content:
+                revdata['contentformat'] = 'text/x-wiki'
+                revdata['contentmodel'] = 'wikitext'
+                revdata['*'] = revision['content']
+                n_content += 1
+            page['revisions'].append(revdata)
+
+        server.n_revisions += n_content
+        if server.revision_latency:
+            time.sleep(server.revision_latency * n_content)
+
+        result['query']['pages'] = pages
+        if badrevids:
+            result['query']['badrevids'] = badrevids
+
+def siteinfo(server, siprop):
+    '''
+    Minimal siteinfo for pywikibot.
+    '''
+
+    (host, port) = server.server_address
+    result = {}
+    props = siprop.split('|')
+    if 'general' in props:
+        result['general'] = {
+            'mainpage': 'Main Page',
+            'base': 'http://{0}:{1}/wiki/Main_Page'.format(host, port),
+            'sitename': 'Mock Wikipedia',
+            'generator': 'MediaWiki 1.25wmf1',
+            'phpversion': '5.5.9',
+            'phpsapi': 'mock',
+            'dbtype': 'sqlite',
+            'dbversion': '3',
+            'case': 'first-letter',
+            'lang': 'en',
+            'fallback': [],
+            'fallback8bitEncoding': 'windows-1252',
+            'writeapi': '',
+            'timezone': 'UTC',
+            'timeoffset': 0,
+            'articlepath': '/wiki/$1',
+            'scriptpath': '/w',
+            'script': '/w/index.php',
+            'server': 'http://{0}:{1}'.format(host, port),
+            'servername': host,
+            'wikiid': 'mockwiki',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'maxuploadsize': 0,
+            'favicon': '',
+            'logo': '',
+        }
+    if 'namespaces' in props:
+        names = {0: '', 1: 'Talk', 2: 'User', 3: 'User talk',
+                 4: 'Wikipedia', 5: 'Wikipedia talk', 6: 'File',
+                 7: 'File talk', 8: 'MediaWiki', 9: 'MediaWiki talk',
+                 10: 'Template', 11: 'Template talk', 12: 'Help',
+                 13: 'Help talk', 14: 'Category', 15: 'Category talk',
+                 -1: 'Special', -2: 'Media'}
+        result['namespaces'] = dict(
+            (str(nsid), {'id': nsid, 'case': 'first-letter', '*': name,
+                         'canonical': name, 'subpages': ''})
+            for (nsid, name) in names.items())
+    for prop in props:
+        if not prop in result:
+            result[prop] = []
+    return result
+
+def read_corpus(filename):
+    '''
+    Read a fixture corpus, returning a dict mapping revision ID to
+    the revision's data.
+
+    @param filename: path to the corpus, one JSON object per line
+    @type filename: str
+    '''
+
+    corpus = {}
+    with open(filename, 'r') as infile:
+        for line in infile:
+            revision = json.loads(line)
+            corpus[revision['revid']] = revision
+    return corpus
+
+def generate_corpus(n_pages=100, revisions_per_page=50, seed=0):
+    '''
+    Generate a corpus of talk page revisions carrying WikiProject
+    banners, with the assessment class changing now and then.  Every
+    fifth talk page starts with a discussion above its banners.
+
+    @param n_pages: number of talk pages
+    @type n_pages: int
+
+    @param revisions_per_page: number of revisions of each talk page
+    @type revisions_per_page: int
+
+    @param seed: seed for the random number generator
+    @type seed: int
+    '''
+
+    rng = random.Random(seed)
+    classes = ['stub', 'start', 'c', 'b', 'ga', 'a', 'fa']
+    projects = ['Biology', 'History', 'Mathematics', 'Music', 'Film']
+
+    corpus = {}
+    revid = 1
+    for pageid in range(1, n_pages + 1):
+        title = u'Talk:Article {0}'.format(pageid)
+        banners = dict((project, rng.randint(0, 3))
+                       for project in rng.sample(projects, rng.randint(1, 3)))
+        discussion = []
+        for i in range(revisions_per_page):
+            if rng.random() < 0.1:
+                project = rng.choice(list(banners))
+                banners[project] = min(banners[project] + 1, len(classes) - 1)
+            else:
+                discussion.append(u'== Section {0} ==\nComment {0}. ~~~~\n'.format(i))
+            content = u''
+            if pageid % 5 == 0:
+                content = u'== Old discussion ==\nAn early comment. ~~~~\n'
+            content += u''.join(
+                u'{{{{WikiProject {0}|class={1}|importance=low}}}}\n'.format(
+                    project, classes[rank])
+                for (project, rank) in sorted(banners.items()))
+            content += u'\n'.join(discussion)
+            corpus[revid] = {'revid': revid,
+                             'pageid': pageid,
+                             'title': title,
+                             'timestamp': '2015-01-01T00:00:{0:02d}Z'.format(i % 60),
+                             'content': content}
+            revid += 1
+    return corpus
+
+def mock_site(url, name='mockwiki'):
+    '''
+    Get a pywikibot site for the mock API at the given URL.
+
+    @param url: URL of the mock API endpoint
+    @type url: str
+
+    @param name: family name to register the endpoint under
+    @type name: str
+    '''
+
+    import pywikibot
+    pywikibot.config.family_files[name] = url
+    return pywikibot.Site(name, name)
@@ -0,0 +1,199 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Writers for assessed-article datasets.
+
+TSV is the default output format.  If pyarrow is installed, datasets
+can also be written as Parquet or Arrow files with an int64 column for
+page IDs and a dictionary-encoded column for assessment classes, written
+in row groups as rows arrive.
+'''
+
+import os
+import codecs
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Output formats we know about
+FORMATS = ['tsv', 'parquet', 'arrow']
+
+class TSVWriter:
+    def __init__(self, filename, columns):
+        '''
+        Open the output file and write the header.
+
+        @param filename: path to the output file
+        @type filename: str
+
+        @param columns: (name, type) of each column, where type is
+                        either "int64" or "class"
+        @type columns: list
+        '''
+
+        self.outfile = codecs.open(os.path.expanduser(filename), 'w+', 'utf-8')
+        self.outfile.write(u'\t'.join(name for (name, coltype) in columns))
+        self.outfile.write(u'\n')
+
+    def write(self, row):
+        '''
+        Write a single row.
+
+        @param row: column values, in the order given by the columns
+        @type row: tuple
+        '''
+        self.outfile.write(u'\t'.join(unicode(value) for value in row))
+        self.outfile.write(u'\n')
+
+    def close(self):
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ColumnarWriter:
+    def __init__(self, filename, columns, classes, file_format='parquet',
+                 row_group_size=1000000):
+        '''
+        Open the output file, rows are buffered and written
+        once we have a full row group.
+
+        @param filename: path to the output file
+        @type filename: str
+
+        @param columns: (name, type) of each column, where type is
+                        either "int64" or "class"
+        @type columns: list
+
+        @param classes: assessment class names, the dictionary used
+                        for all "class" columns
+        @type classes: list
+
+        @param file_format: "parquet" or "arrow"
+        @type file_format: str
+
+        @param row_group_size: number of rows per row group
+        @type row_group_size: int
+        '''
+
+        if pyarrow is None:
+            raise ValueError('pyarrow is required to write {0} output'.format(file_format))
+
+        self.filename = os.path.expanduser(filename)
+        self.columns = columns
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+
+        # The dictionary is fixed up front, Arrow files do not allow
+        # it to change between row groups.
+        self.dictionary = pyarrow.array(list(classes), type=pyarrow.string())
+        self.class_codes = dict((classname, code)
+                                for (code, classname) in enumerate(classes))
+
+        self.fields = []
+        for (name, coltype) in columns:
+            if coltype == 'int64':
+                self.fields.append(pyarrow.field(name, pyarrow.int64()))
+            elif coltype == 'class':
+                self.fields.append(pyarrow.field(
+                    name, pyarrow.dictionary(pyarrow.int8(),
+                                             pyarrow.string())))
+            else:
+                raise ValueError('unknown column type {0}'.format(coltype))
+        self.schema = pyarrow.schema(self.fields)
+
+        if file_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename,
+                                                        self.schema)
+        elif file_format == 'arrow':
+            self.sink = pyarrow.OSFile(self.filename, 'wb')
+            self.writer = pyarrow.ipc.new_file(self.sink, self.schema)
+        else:
+            raise ValueError('unknown output format {0}'.format(file_format))
+
+        self.buffers = [[] for column in columns]
+
+    def write(self, row):
+        '''
+        Write a single row.
+
+        @param row: column values, in the order given by the columns
+        @type row: tuple
+        '''
+
+        for (buf, value) in zip(self.buffers, row):
+            buf.append(value)
+
+        if len(self.buffers[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write any buffered rows as a row group.
+        '''
+
+        if not self.buffers[0]:
+            return
+
+        arrays = []
+        for ((name, coltype), buf) in zip(self.columns, self.buffers):
+            if coltype == 'int64':
+                arrays.append(pyarrow.array(buf, type=pyarrow.int64()))
+            else:
+                codes = pyarrow.array([self.class_codes[value]
+                                       for value in buf],
+                                      type=pyarrow.int8())
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    codes, self.dictionary))
+
+        batch = pyarrow.RecordBatch.from_arrays(
+            arrays, [name for (name, coltype) in self.columns])
+        if self.file_format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+        self.buffers = [[] for column in self.columns]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.file_format == 'arrow':
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_writer(filename, columns, classes, file_format='tsv'):
+    '''
+    Open a writer for the given output format.
+
+    @param filename: path to the output file
+    @type filename: str
+
+    @param columns: (name, type) of each column, where type is
+                    either "int64" or "class"
+    @type columns: list
+
+    @param classes: assessment class names that can appear in
+                    "class" columns
+    @type classes: list
+
+    @param file_format: one of "tsv", "parquet", or "arrow"
+    @type file_format: str
+    '''
+
+    if file_format == 'tsv':
+        return TSVWriter(filename, columns)
+    return ColumnarWriter(filename, columns, classes,
+                          file_format=file_format)
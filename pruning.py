@@ -0,0 +1,76 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Pruning of talk page revisions using their metadata, to find where
+an assessment changed while fetching the content of few revisions.
+
+Most talk page edits are replies to discussions, which do not touch
+the banners.  The edits that do tend to stand out in the revision
+table: their edit summaries mention assessments or banners, they are
+made by bots that tag pages for WikiProjects, or they change the
+length of the page by only a few bytes (a new class or importance
+replacing the old one) or shorten it.  candidates() picks these
+revisions out of a talk page's history.
+
+The candidates are only fetched and assessed first.  An assessment can
+also change in an edit that is not a candidate, e.g. one that adds a
+discussion and reassesses the page at the same time, so all revisions
+down to where the candidates show the class changing are still
+assessed, see AssessmentFinder.find_class_start() in
+clean-training-set.py.
+'''
+
+import re
+
+# Edit summaries of edits that are likely to change assessments
+comment_re = re.compile(r'assess|rating|\brated?\b|\bclass\b|wikiproject|banner|importance|\bwp ?1\.0\b|\btag', re.I)
+
+# Bots known to add and update WikiProject banners
+assessment_bots = frozenset(['Yobot', 'BattyBot', 'AnomieBOT', 'Cewbot',
+                             'Kingbotk'])
+
+# Changes in length of at most this many bytes are likely
+# to be a rating replacing another
+small_delta = 16
+
+def is_candidate(revision, delta):
+    '''
+    Is the given revision likely to change the assessments of the page?
+
+    @param revision: talk page revision with length, comment and user
+    @type revision: TPRevision
+
+    @param delta: change in the length of the page made by the revision,
+                  None if we do not know it
+    @type delta: int
+    '''
+
+    if delta is None or delta < 0 or abs(delta) <= small_delta:
+        return True
+    if revision.user in assessment_bots:
+        return True
+    return bool(comment_re.search(revision.comment or ''))
+
+def candidates(tp_revs):
+    '''
+    Get the revisions likely to change the assessments of a talk page,
+    newest first, going through its revisions only as far as needed.
+
+    @param tp_revs: all revisions of the talk page up to some point,
+                    newest first
+    @type tp_revs: iterable
+    '''
+
+    newer = None
+    for revision in tp_revs:
+        if newer is not None:
+            delta = None
+            if newer.length is not None and revision.length is not None:
+                delta = newer.length - revision.length
+            if is_candidate(newer, delta):
+                yield newer
+        newer = revision
+
+    # the oldest revision, we don't know what it changed
+    if newer is not None and is_candidate(newer, None):
+        yield newer
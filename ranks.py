@@ -0,0 +1,94 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Resolution of the highest assessment class of each article.
+
+An article is assumed to belong to the highest class it is assessed as.
+Rather than subtracting the articles of each class from the next, we
+record the best class rank seen for every page ID in a dense byte array
+indexed by page ID.  Classes can then be added in any order, and the
+result is read out in a single pass over the array.
+'''
+
+import re
+import threading
+
+class ClassRanks:
+    def __init__(self, classes):
+        '''
+        Instantiate an empty rank array.
+
+        @param classes: assessment classes, ordered from highest to lowest
+        @type classes: list
+        '''
+
+        self.classes = list(classes)
+
+        # Byte N holds the rank of page ID N, 0 means the page is unassessed
+        # and rank K means self.classes[K-1], so lower is better.
+        self.ranks = bytearray()
+
+        # Guards the array so that classes can be added concurrently
+        self.lock = threading.Lock()
+
+        # Matches any assessed page when scanning the array
+        self.assessed_re = re.compile(b'[^\x00]')
+
+    def add(self, pageids, assessment_class):
+        '''
+        Record that the given pages are assessed as the given class,
+        keeping the best class seen for each page.
+
+        @param pageids: page IDs of the articles
+        @type pageids: iterable
+
+        @param assessment_class: class the articles are assessed as
+        @type assessment_class: str
+        '''
+
+        rank = self.classes.index(assessment_class) + 1
+        pageids = list(pageids)
+        if not pageids:
+            return
+
+        with self.lock:
+            max_pageid = max(pageids)
+            if max_pageid >= len(self.ranks):
+                self.ranks.extend(b'\x00' * (max_pageid + 1 - len(self.ranks)))
+
+            ranks = self.ranks
+            for pageid in pageids:
+                cur_rank = ranks[pageid]
+                if not cur_rank or rank < cur_rank:
+                    ranks[pageid] = rank
+
+    def __len__(self):
+        '''
+        Number of assessed pages.
+        '''
+        return len(self.ranks) - self.ranks.count(b'\x00')
+
+    def items(self):
+        '''
+        Iterate over (page ID, assessment class) for all assessed pages,
+        ordered by page ID.
+        '''
+
+        ranks = self.ranks
+        classes = self.classes
+        for match in self.assessed_re.finditer(ranks):
+            pageid = match.start()
+            yield (pageid, classes[ranks[pageid] - 1])
+
+    def pages(self, assessment_class):
+        '''
+        Get the page IDs of all pages whose highest class is
+        the given class, ordered by page ID.
+
+        @param assessment_class: the assessment class
+        @type assessment_class: str
+        '''
+
+        rank = self.classes.index(assessment_class) + 1
+        rank_re = re.compile(re.escape(chr(rank)))
+        return [match.start() for match in rank_re.finditer(self.ranks)]
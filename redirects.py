@@ -0,0 +1,212 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Redirect resolution shared by all category traversals in a process.
+
+Redirects are looked up in bulk against the redirect table and their
+targets stored in a map, so each redirect is resolved at most once.
+The map can optionally be persisted between runs.  A stored redirect is
+kept together with the latest revision IDs of the redirect and of its
+target.  Retargeting the redirect, or editing, moving or deleting the
+target, changes these, so on the first lookup of a run they are checked
+in bulk against the page table and the redirects that changed are
+resolved again.  Redirects to missing pages are not stored.
+'''
+
+import os
+import json
+import logging
+
+class RedirectResolver:
+    def __init__(self, filename=None):
+        '''
+        Instantiate the resolver, reading the stored map from disk
+        if a filename is given and the file exists.
+
+        @param filename: path to the file storing the redirect map
+        @type filename: str
+        '''
+
+        self.filename = None
+        if filename:
+            self.filename = os.path.expanduser(filename)
+
+        # Maps redirect page ID (rd_from) to a tuple of the target's
+        # (namespace, page ID, title, is redirect), or None if the
+        # redirect does not point to an existing page.
+        self.targets = {}
+
+        # Maps redirect page ID to a tuple of the latest revision IDs
+        # of the redirect and its target when it was resolved
+        self.latest = {}
+
+        # Have we checked the stored redirects against the page table yet?
+        self.validated = False
+
+        # Query to get the targets of a set of redirects
+        self.resolve_query = ur'''SELECT rd_from, r.page_latest AS rd_latest,
+                                         t.page_namespace, t.page_id,
+                                         t.page_title, t.page_is_redirect,
+                                         t.page_latest AS target_latest
+                                  FROM redirect
+                                  JOIN page AS t
+                                  ON (rd_namespace=t.page_namespace
+                                  AND rd_title=t.page_title)
+                                  JOIN page AS r
+                                  ON r.page_id=rd_from
+                                  WHERE rd_from IN ({pageidlist})'''
+
+        # Query to get the latest revision of a set of pages
+        self.latest_query = ur'''SELECT page_id, page_latest
+                                 FROM page
+                                 WHERE page_id IN ({pageidlist})'''
+
+        self.slice_size = 1000
+
+        # Number of redirects looked up in the database,
+        # and number of lookups answered from the map
+        self.n_queried = 0
+        self.n_hits = 0
+
+        if self.filename:
+            self.load()
+
+    def load(self):
+        '''
+        Read the redirect map from disk, if it exists.
+        '''
+
+        if not os.path.exists(self.filename):
+            logging.info('no redirect map found at {0}'.format(self.filename))
+            return
+
+        try:
+            with open(self.filename, 'r') as infile:
+                stored = json.load(infile)
+        except (IOError, ValueError) as e:
+            logging.warning('unable to read redirect map {0}: {1}'.format(self.filename, e))
+            return
+
+        for (rd_from, stored_target) in stored.iteritems():
+            # namespace, page ID, title, is redirect, and latest revision
+            # IDs of the redirect and the target, anything else is from
+            # an older version of the map and resolved again
+            if not stored_target or len(stored_target) != 6:
+                continue
+            self.targets[int(rd_from)] = tuple(stored_target[:4])
+            self.latest[int(rd_from)] = tuple(stored_target[4:])
+
+        logging.info('read {n} redirects from {0}'.format(self.filename, n=len(self.targets)))
+
+    def save(self):
+        '''
+        Write the redirect map to disk, if we have a filename.
+        '''
+
+        if not self.filename:
+            return
+
+        stored = dict((rd_from, list(target) + list(self.latest[rd_from]))
+                      for (rd_from, target) in self.targets.iteritems()
+                      if target)
+
+        tmp_filename = '{0}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(stored, outfile)
+        os.rename(tmp_filename, self.filename)
+
+        logging.info('wrote {n} redirects to {0}'.format(self.filename, n=len(stored)))
+
+    def validate(self, dbcursor):
+        '''
+        Check the stored redirects against the page table and forget
+        those where the redirect or its target has changed.
+
+        @param dbcursor: database cursor to use for the queries
+        @type dbcursor: MySQLdb.cursors.SSDictCursor
+        '''
+
+        if self.validated:
+            return
+        self.validated = True
+
+        if not self.targets:
+            return
+
+        pageids = set(self.targets.keys())
+        pageids.update(target[1] for target in self.targets.values())
+        pageids = [str(pageid) for pageid in pageids]
+
+        # deleted pages are not in the page table
+        latest = {}
+        i = 0
+        while i < len(pageids):
+            dbcursor.execute(self.latest_query.format(
+                pageidlist=",".join(pageids[i:i+self.slice_size])))
+            for row in dbcursor.fetchall():
+                latest[row['page_id']] = row['page_latest']
+            i += self.slice_size
+
+        changed = [rd_from for (rd_from, target) in self.targets.iteritems()
+                   if (latest.get(rd_from), latest.get(target[1])) != self.latest[rd_from]]
+        for rd_from in changed:
+            del self.targets[rd_from]
+            del self.latest[rd_from]
+
+        logging.info('validated {n} stored redirects, {k} need to be resolved again'.format(n=len(self.targets) + len(changed), k=len(changed)))
+
+    def resolve(self, dbcursor, pageids, namespace):
+        '''
+        Resolve the given redirects, querying the database only for
+        those we have not seen before.
+
+        Returns a dict mapping redirect page ID (as int) to a tuple
+        (page ID, title) of its target, for redirects pointing to a page
+        in the given namespace that is not itself a redirect.
+
+        @param dbcursor: database cursor to use for the queries
+        @type dbcursor: MySQLdb.cursors.SSDictCursor
+
+        @param pageids: page IDs of the redirects
+        @type pageids: iterable
+
+        @param namespace: namespace the targets have to be in
+        @type namespace: int
+        '''
+
+        self.validate(dbcursor)
+
+        pageids = set(int(pageid) for pageid in pageids)
+        unknown = [str(pageid) for pageid in pageids
+                   if not pageid in self.targets]
+
+        self.n_hits += len(pageids) - len(unknown)
+        self.n_queried += len(unknown)
+
+        i = 0
+        while i < len(unknown):
+            id_subset = unknown[i:i+self.slice_size]
+            # redirects not found below point to missing pages
+            for pageid in id_subset:
+                self.targets[int(pageid)] = None
+
+            dbcursor.execute(self.resolve_query.format(
+                pageidlist=",".join(id_subset)))
+            for row in dbcursor.fetchall():
+                self.targets[row['rd_from']] = (
+                    row['page_namespace'],
+                    row['page_id'],
+                    unicode(row['page_title'], 'utf-8', errors='strict'),
+                    bool(row['page_is_redirect']))
+                self.latest[row['rd_from']] = (row['rd_latest'],
+                                               row['target_latest'])
+
+            i += self.slice_size
+
+        result = {}
+        for pageid in pageids:
+            target = self.targets[pageid]
+            if target and target[0] == namespace and not target[3]:
+                result[pageid] = (target[1], target[2])
+
+        return result
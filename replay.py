@@ -0,0 +1,229 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Record and replay of replica and API traffic.
+
+In recording mode every query result from the replica and every API
+response is captured and written to a compact file.  In replay mode
+they are served back from that file without touching the network, so
+the same workload can be run repeatedly, e.g. to compare throughput
+before and after a change.
+
+Both modes provide connect() and site() in place of db.connect() and
+pywikibot.Site(), and API requests are made through api_request(),
+see revisions.api_request().
+'''
+
+import db
+
+import gzip
+import logging
+import cPickle as pickle
+
+class ReplayError(LookupError):
+    '''
+    Raised when replaying a request that was not recorded.
+    '''
+    pass
+
+def query_key(query, params=None):
+    '''
+    Key identifying a database query.
+    '''
+    if params:
+        params = tuple(sorted(params.items()))
+    return (query, params)
+
+def api_key(params):
+    '''
+    Key identifying an API request.
+    '''
+    return tuple(sorted((key, unicode(value))
+                        for (key, value) in params.items()))
+
+class TrafficLog:
+    def __init__(self):
+        # Maps query key to a list of results (each a list of rows),
+        # and API request key to a list of responses, in the order
+        # they were seen.
+        self.queries = {}
+        self.requests = {}
+
+        # Number of times each query and API request has been replayed
+        self.replayed_queries = {}
+        self.replayed_requests = {}
+
+    def load(self, filename):
+        with gzip.open(filename, 'rb') as infile:
+            (self.queries, self.requests) = pickle.load(infile)
+
+    def save(self, filename):
+        with gzip.open(filename, 'wb') as outfile:
+            pickle.dump((self.queries, self.requests), outfile,
+                        pickle.HIGHEST_PROTOCOL)
+
+class ResultCursor:
+    '''
+    Cursor that serves a list of dict rows, like an SSDictCursor.
+    '''
+
+    def __init__(self):
+        self.rows = []
+        self.pos = 0
+
+    def set_result(self, rows):
+        self.rows = rows
+        self.pos = 0
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return tuple(rows)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+class RecordingCursor(ResultCursor):
+    def __init__(self, cursor, log):
+        ResultCursor.__init__(self)
+        self.cursor = cursor
+        self.log = log
+
+    def execute(self, query, params=None):
+        if params is None:
+            result = self.cursor.execute(query)
+        else:
+            result = self.cursor.execute(query, params)
+        rows = list(self.cursor.fetchall())
+        self.log.queries.setdefault(query_key(query, params), []).append(rows)
+        self.set_result(rows)
+        return result
+
+    def close(self):
+        self.cursor.close()
+
+class ReplayCursor(ResultCursor):
+    def __init__(self, log):
+        ResultCursor.__init__(self)
+        self.log = log
+
+    def execute(self, query, params=None):
+        key = query_key(query, params)
+        try:
+            results = self.log.queries[key]
+        except KeyError:
+            raise ReplayError('query was not recorded: {0} {1}'.format(query, params))
+
+        # replay repeated queries in order, then stick with the last result
+        i = self.log.replayed_queries.get(key, 0)
+        self.log.replayed_queries[key] = i + 1
+        self.set_result(results[min(i, len(results) - 1)])
+        return len(self.rows)
+
+    def close(self):
+        pass
+
+class ReplayConnection:
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+class RecordingSite:
+    '''
+    Wraps a pywikibot site, recording the responses to API requests.
+    '''
+
+    def __init__(self, site, log):
+        self.site = site
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.site, name)
+
+    def api_request(self, params):
+        import pywikibot
+        data = pywikibot.data.api.Request(site=self.site, **params).submit()
+        self.log.requests.setdefault(api_key(params), []).append(data)
+        return data
+
+class ReplaySite:
+    '''
+    Stands in for a pywikibot site, serving recorded API responses.
+    '''
+
+    def __init__(self, log):
+        self.log = log
+
+    def login(self):
+        pass
+
+    def api_request(self, params):
+        key = api_key(params)
+        try:
+            responses = self.log.requests[key]
+        except KeyError:
+            raise ReplayError('API request was not recorded: {0}'.format(params))
+
+        i = self.log.replayed_requests.get(key, 0)
+        self.log.replayed_requests[key] = i + 1
+        return responses[min(i, len(responses) - 1)]
+
+class Recorder:
+    def __init__(self, filename):
+        '''
+        Record traffic, writing it to the given file on save().
+
+        @param filename: path to the recording
+        @type filename: str
+        '''
+
+        self.filename = filename
+        self.log = TrafficLog()
+
+    def connect(self, slowlog=None):
+        (dbconn, dbcursor) = db.connect(slowlog=slowlog)
+        if dbcursor:
+            dbcursor = RecordingCursor(dbcursor, self.log)
+        return (dbconn, dbcursor)
+
+    def site(self, code='en'):
+        import pywikibot
+        return RecordingSite(pywikibot.Site(code), self.log)
+
+    def save(self):
+        self.log.save(self.filename)
+        logging.info('recorded {n} queries and {k} API requests to {0}'.format(
+            self.filename, n=len(self.log.queries), k=len(self.log.requests)))
+
+class Replayer:
+    def __init__(self, filename):
+        '''
+        Replay traffic from the given recording.
+
+        @param filename: path to the recording
+        @type filename: str
+        '''
+
+        self.filename = filename
+        self.log = TrafficLog()
+        self.log.load(filename)
+
+    def connect(self, slowlog=None):
+        return (ReplayConnection(), ReplayCursor(self.log))
+
+    def site(self, code='en'):
+        return ReplaySite(self.log)
+
+    def save(self):
+        pass
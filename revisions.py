@@ -5,11 +5,37 @@ Utility function for efficiently fetching a set of revisions from
 the Wikipedia API through pywikibot.
 '''
 
+import time
 import logging
-import pywikibot
 from collections import namedtuple
 
-def get_revisions(site, revisions, errorpages={}):
+from batching import AdaptiveSlice
+
+# Number of revisions to ask for per request, shared by all callers.
+# The API returns at most 50 revisions with content per request.
+revision_slices = AdaptiveSlice(size=10, minimum=1, maximum=50)
+
+def api_request(site, params):
+    '''
+    Make an API request with the given parameters and return the result.
+
+    Sites that record or replay traffic (see replay.py) make the
+    request themselves.
+
+    @param site: site we're querying
+    @type site: pywikibot.Site
+
+    @param params: request parameters
+    @type params: dict
+    '''
+
+    if hasattr(site, 'api_request'):
+        return site.api_request(params)
+
+    import pywikibot
+    return pywikibot.data.api.Request(site=site, **params).submit()
+
+def get_revisions(site, revisions, errorpages={}, slices=None):
     '''
     Use the API for the given Wikipedia site to efficiently fetch
     revisions given a list of revision (namedtuples).
@@ -26,10 +52,14 @@ def get_revisions(site, revisions, errorpages={}):
 
     @param errorpages: dictionary storing info about pages with errors
     @type errorpages: dict
+
+    @param slices: controller of the number of revisions per request,
+                   by default the one shared by all callers
+    @type slices: batching.AdaptiveSlice
     '''
 
-    # How many pages at a time can we process?
-    slice_size = 10
+    if slices is None:
+        slices = revision_slices
 
     # We get in a list of revisions, but from the API we'll get
     # pages and a list of revisions.  Make a map for easy retrieval
@@ -38,39 +68,56 @@ def get_revisions(site, revisions, errorpages={}):
 
     i = 0
     while i < len(revisions):
+        # How many pages at a time can we process?
+        slice_size = slices.size
+
         # make an API query to get info about a subset of pages
         id_subset = revisions[i:i+slice_size]
 
         # This query might get truncated because we're requesting revisions
-        req = pywikibot.data.api.Request(site=site,
-                                         action='query')
-        req['prop'] = u'info|revisions'
-        req['rvprop'] = u'ids|timestamp|size|content'
-        req['revids'] = "|".join(str(rev.id) for rev in id_subset)
+        params = {'action': 'query',
+                  'prop': u'info|revisions',
+                  'rvprop': u'ids|timestamp|size|content',
+                  'revids': "|".join(str(rev.id) for rev in id_subset)}
 
-        requestdata = {}
+        # Continued queries return the remaining revisions in new
+        # responses, so keep all of them.
+        responses = []
 
+        query_start = time.time()
         query_done = False
         while not query_done:
-            data = req.submit()
-            requestdata.update(data)
+            try:
+                data = api_request(site, params)
+            except Exception:
+                slices.failed()
+                raise
+            responses.append(data)
             if 'query-continue' in data:
                 # Example: {u'revisions': {u'rvcontinue': u'446891|552013814'}}
                 logging.info(u'query-continue: {cont}'.format(cont=data['query-continue']))
                 for contprop, contdata in data['query-continue'].iteritems():
                     for contkey, contval in contdata.iteritems():
-                        req[contkey] = contval
+                        params[contkey] = contval
             else:
                 query_done = True
+        # lag reported while we made the requests, if they were scheduled
+        lag = None
+        scheduler = getattr(site, 'scheduler', None)
+        if scheduler is not None:
+            lag = scheduler.lag_since(query_start)
+        slices.record(len(id_subset), 0, time.time() - query_start, lag=lag)
 
         # data.keys() = [u'query']
         # data['query'].keys() = [u'pages', u'userinfo']
         # data['query']['pages'] is a dict mapping page IDs (as strings)
         # to data for a given page
 
-        if not 'pages' in requestdata['query']:
-            logging.warning("No info about pages in API info query")
-        else:
+        for requestdata in responses:
+            if not 'pages' in requestdata['query']:
+                logging.warning("No info about pages in API info query")
+                continue
+
             for pageid, pagedata in requestdata['query']['pages'].iteritems():
                 logging.info("Processing page ID {pageid}".format(pageid=pageid))
 
@@ -85,6 +132,8 @@ def get_revisions(site, revisions, errorpages={}):
                     try:
                         content = revision['*']
                     except KeyError:
+                        if revisions_map[revid].content is not None:
+                            continue # got it in an earlier response
                         logging.warning(u'Failed to get revision text for revision {revid}'.format(revid=revid))
                         content = None
                     # store in our dictionary
@@ -0,0 +1,265 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Synthetic stand-in for the replica database, used for benchmarking.
+
+Builds a SQLite database with the page, categorylinks, redirect and
+category tables, filled with a generated WP1.0 assessment category tree
+of configurable size, and provides a cursor that accepts the MySQLdb
+queries used in our scripts and counts queries and rows transferred.
+'''
+
+import re
+import random
+import sqlite3
+import logging
+
+# Assessment classes in the synthetic tree
+CLASSES = ['FA', 'A', 'GA', 'B', 'C', 'Start', 'Stub']
+
+SCHEMA = [
+    '''CREATE TABLE page (
+         page_id INTEGER PRIMARY KEY,
+         page_namespace INTEGER NOT NULL,
+         page_title TEXT NOT NULL,
+         page_is_redirect INTEGER NOT NULL DEFAULT 0,
+         page_latest INTEGER NOT NULL DEFAULT 0,
+         page_random REAL NOT NULL DEFAULT 0)''',
+    '''CREATE UNIQUE INDEX name_title ON page (page_namespace, page_title)''',
+    '''CREATE INDEX page_title ON page (page_title)''',
+    '''CREATE TABLE categorylinks (
+         cl_from INTEGER NOT NULL,
+         cl_to TEXT NOT NULL,
+         cl_timestamp TEXT NOT NULL,
+         cl_type TEXT NOT NULL)''',
+    '''CREATE UNIQUE INDEX cl_from ON categorylinks (cl_from, cl_to)''',
+    '''CREATE INDEX cl_to ON categorylinks (cl_to)''',
+    '''CREATE TABLE redirect (
+         rd_from INTEGER PRIMARY KEY,
+         rd_namespace INTEGER NOT NULL,
+         rd_title TEXT NOT NULL)''',
+    '''CREATE TABLE category (
+         cat_id INTEGER PRIMARY KEY,
+         cat_title TEXT NOT NULL,
+         cat_pages INTEGER NOT NULL DEFAULT 0,
+         cat_subcats INTEGER NOT NULL DEFAULT 0,
+         cat_files INTEGER NOT NULL DEFAULT 0)''',
+    '''CREATE UNIQUE INDEX cat_title ON category (cat_title)''',
+]
+
+class SQLiteCursor:
+    '''
+    Cursor over a SQLite database that behaves like MySQLdb's
+    SSDictCursor for the queries in our scripts, rewriting pyformat
+    parameters to SQLite's named style and returning rows as dicts.
+    '''
+
+    param_re = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.columns = []
+
+        # Number of queries executed, and rows fetched
+        self.n_queries = 0
+        self.n_rows = 0
+
+    def execute(self, query, params=None):
+        if params is not None:
+            # MySQLdb only interpolates when given parameters
+            query = self.param_re.sub(r':\1', query).replace('%%', '%')
+        else:
+            params = {}
+
+        self.n_queries += 1
+        self.cursor.execute(query, params)
+        self.columns = []
+        if self.cursor.description:
+            self.columns = [column[0] for column in self.cursor.description]
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        self.n_rows += 1
+        return dict(zip(self.columns, row))
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.n_rows += len(rows)
+        return tuple(dict(zip(self.columns, row)) for row in rows)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+def connect(filename):
+    '''
+    Open a synthetic database, returning a (connection, cursor) tuple
+    like db.connect().
+
+    @param filename: path to the SQLite database file
+    @type filename: str
+    '''
+
+    conn = sqlite3.connect(filename)
+    # page titles are binary on the replicas
+    conn.text_factory = str
+    # LIKE is case-sensitive on binary columns in MySQL
+    conn.execute('PRAGMA case_sensitive_like=ON')
+    # a replica that never lags
+    conn.execute("ATTACH DATABASE ':memory:' AS heartbeat_p")
+    conn.execute('CREATE TABLE heartbeat_p.heartbeat (shard TEXT, lag REAL)')
+    conn.execute("INSERT INTO heartbeat_p.heartbeat VALUES ('s1', 0)")
+    return (conn, SQLiteCursor(conn))
+
+def generate(filename, n_projects=5, depth=2, fanout=3, n_articles=10000,
+             redirect_ratio=0.1, seed=0):
+    '''
+    Generate a synthetic assessment category tree in a new database.
+
+    Each WikiProject gets an "X_articles_by_quality" category under
+    "Wikipedia_1.0_assessments", with one category per assessment class
+    and a sub-category tree of the given depth and fan-out below that.
+    Articles have their talk pages tagged by one to three projects,
+    usually with the same class.
+
+    @param filename: path to the SQLite database file to create
+    @type filename: str
+
+    @param n_projects: number of WikiProjects
+    @type n_projects: int
+
+    @param depth: depth of each class's sub-category tree
+    @type depth: int
+
+    @param fanout: number of sub-categories of each category
+    @type fanout: int
+
+    @param n_articles: number of articles
+    @type n_articles: int
+
+    @param redirect_ratio: proportion of sub-categories and tagged talk
+                           pages that are redirects
+    @type redirect_ratio: float
+
+    @param seed: seed for the random number generator
+    @type seed: int
+    '''
+
+    rng = random.Random(seed)
+
+    pages = []
+    links = []
+    redirects = []
+    members = {} # category title -> list of member namespaces
+
+    def add_page(namespace, title, is_redirect=0):
+        pageid = len(pages) + 1
+        pages.append((pageid, namespace, title, is_redirect,
+                      0, rng.random()))
+        return pageid
+
+    def add_link(pageid, namespace, category):
+        cl_type = 'page'
+        if namespace == 14:
+            cl_type = 'subcat'
+        links.append((pageid, category, '2015-01-01 00:00:00', cl_type))
+        members.setdefault(category, []).append(namespace)
+
+    startcat = 'Wikipedia_1.0_assessments'
+    add_page(14, startcat)
+
+    # Maps (project, class) to the titles of all categories in its tree
+    class_cats = {}
+    for k in range(n_projects):
+        project = 'Project{0}'.format(k)
+        by_quality = '{0}_articles_by_quality'.format(project)
+        add_link(add_page(14, by_quality), 14, startcat)
+
+        for assessment_class in CLASSES:
+            top = '{0}-Class_{1}_articles'.format(assessment_class, project)
+            add_link(add_page(14, top), 14, by_quality)
+            tree = [top]
+            level = [top]
+            n = 0
+            for d in range(depth):
+                next_level = []
+                for parent in level:
+                    for f in range(fanout):
+                        title = '{0}-Class_{1}_group_{2}_articles'.format(
+                            assessment_class, project, n)
+                        pageid = add_page(14, title)
+                        if rng.random() < redirect_ratio:
+                            # only reachable through a category redirect
+                            rd_title = '{0}-Class_{1}_old_group_{2}_articles'.format(
+                                assessment_class, project, n)
+                            rd_id = add_page(14, rd_title, is_redirect=1)
+                            redirects.append((rd_id, 14, title))
+                            add_link(rd_id, 14, parent)
+                        else:
+                            add_link(pageid, 14, parent)
+                        next_level.append(title)
+                        tree.append(title)
+                        n += 1
+                level = next_level
+            class_cats[(project, assessment_class)] = tree
+
+    dab_cat = 'All_article_disambiguation_pages'
+
+    def tag(talk_id):
+        projects = rng.sample(range(n_projects),
+                              min(n_projects, rng.randint(1, 3)))
+        assessment_class = rng.choice(CLASSES)
+        for k in projects:
+            if rng.random() < 0.2:
+                # projects sometimes disagree
+                assessment_class = rng.choice(CLASSES)
+            tree = class_cats[('Project{0}'.format(k), assessment_class)]
+            add_link(talk_id, 1, rng.choice(tree))
+
+    titles = []
+    for i in range(n_articles):
+        r = rng.random()
+        if r < 0.01:
+            title = 'List_of_things_{0}'.format(i)
+        elif r < 0.02:
+            title = 'Thing_{0}_(disambiguation)'.format(i)
+        else:
+            title = 'Article_{0}'.format(i)
+        article_id = add_page(0, title)
+        if rng.random() < 0.01:
+            add_link(article_id, 0, dab_cat)
+        titles.append(title)
+        tag(add_page(1, title))
+
+    for j in range(int(n_articles * redirect_ratio)):
+        title = 'Redirect_{0}'.format(j)
+        rd_id = add_page(0, title, is_redirect=1)
+        redirects.append((rd_id, 0, rng.choice(titles)))
+        tag(add_page(1, title))
+
+    categories = []
+    for (title, namespaces) in members.items():
+        categories.append((len(categories) + 1, title, len(namespaces),
+                           namespaces.count(14), 0))
+
+    conn = sqlite3.connect(filename)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO page VALUES (?, ?, ?, ?, ?, ?)', pages)
+    conn.executemany('INSERT INTO categorylinks VALUES (?, ?, ?, ?)', links)
+    conn.executemany('INSERT INTO redirect VALUES (?, ?, ?)', redirects)
+    conn.executemany('INSERT INTO category VALUES (?, ?, ?, ?, ?)',
+                     categories)
+    conn.commit()
+    conn.close()
+
+    logging.info('generated {n} pages, {k} category links and {r} redirects in {0}'.format(filename, n=len(pages), k=len(links), r=len(redirects)))
@@ -0,0 +1,289 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Memory-mapped index of assessment classes over time, answering what
+class a page had at a given time from assessment timelines (see
+timeline.py), without touching the database or the API.
+
+The index is a binary file with a small header listing the assessment
+classes, followed by one little-endian uint64 key per interval and then
+one byte per interval giving its class.  The key is the page ID in the
+high 32 bits and the interval's start as seconds since the epoch in
+the low 32, so the keys sort by page and then by time, and a lookup is
+a single binary search for the last interval starting at or before the
+given time.  A page has the class of that interval until the next one
+starts; before its first interval it has no class.
+
+The index is usually exported from a timeline cache (see
+TimelineCache.export_index() and the --time-index option of
+clean-training-set.py).  The timelines there often stop at the first
+interval with a different class than the one being looked for, or
+skip revisions when pruning.  Then the page's oldest interval starts
+at the oldest revision that was looked at rather than when its class
+was given.  Before that, lookups give no class, which for such a page
+means that its class is not known, not that it had none.
+
+If numpy is installed, batch lookups are vectorised.
+'''
+
+import os
+import mmap
+import struct
+import bisect
+import calendar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from assessment import wp10_scale
+
+MAGIC = b'ATI1'
+
+# magic, number of records, number of classes
+HEADER = struct.Struct('<4sIB')
+
+# Class code of intervals without a valid assessment
+UNASSESSED = 255
+
+def to_seconds(timestamp):
+    '''
+    Convert a MediaWiki timestamp to seconds since the epoch.
+
+    @param timestamp: timestamp as in rev_timestamp, e.g. "20150131235959"
+    @type timestamp: str or int
+    '''
+
+    timestamp = str(timestamp)
+    return calendar.timegm((int(timestamp[0:4]), int(timestamp[4:6]),
+                            int(timestamp[6:8]), int(timestamp[8:10]),
+                            int(timestamp[10:12]), int(timestamp[12:14]),
+                            0, 0, 0))
+
+def make_key(pageid, timestamp):
+    '''
+    Get the index key of the given page at the given time.
+    '''
+    return (pageid << 32) | to_seconds(timestamp)
+
+class TimeIndexWriter:
+    def __init__(self, filename, classes=None):
+        '''
+        Open the index file for writing.  Intervals have to be written
+        in increasing page ID order, and by start time within a page.
+        Intervals of a page starting in the same second replace each
+        other, the last one written is kept.
+
+        @param filename: path to the index file
+        @type filename: str
+
+        @param classes: assessment class names, ordered by rank,
+                        by default the WP 1.0 scale
+        @type classes: list
+        '''
+
+        if classes is None:
+            classes = sorted(wp10_scale, key=wp10_scale.get)
+
+        self.outfile = open(os.path.expanduser(filename), 'wb')
+        self.classes = list(classes)
+
+        # header with a placeholder count, filled in on close
+        header = [HEADER.pack(MAGIC, 0, len(self.classes))]
+        for classname in self.classes:
+            classname = classname.encode('utf-8')
+            header.append(struct.pack('<B', len(classname)))
+            header.append(classname)
+        header = b''.join(header)
+        # pad so that the key column is aligned
+        header += b'\x00' * (-len(header) % 8)
+        self.outfile.write(header)
+
+        self.n_records = 0
+        self.last_key = -1
+        self.last_pageid = None
+        self.last_rank = None
+        self.codes = bytearray()
+
+    def write(self, row):
+        '''
+        Add an interval to the index.
+
+        @param row: page ID, start timestamp and rank of the interval,
+                    the rank is None if the page was not assessed
+        @type row: tuple
+        '''
+
+        (pageid, timestamp, rank) = row
+        key = make_key(pageid, timestamp)
+        if key < self.last_key:
+            raise ValueError('intervals must be written in increasing page ID and time order')
+
+        code = rank
+        if rank is None:
+            code = UNASSESSED
+
+        self.last_pageid = pageid
+        self.last_rank = rank
+        if key == self.last_key:
+            # the class changed again within the second, the key
+            # is already written, so only the class is replaced
+            self.codes[-1] = code
+            return
+        self.last_key = key
+
+        self.outfile.write(struct.pack('<Q', key))
+        self.codes.append(code)
+        self.n_records += 1
+
+    def write_timeline(self, pageid, intervals):
+        '''
+        Add the timeline of a page to the index, leaving out intervals
+        that do not change its class.
+
+        @param pageid: page ID to index the timeline under, usually
+                       the article's rather than the talk page's
+        @type pageid: int
+
+        @param intervals: the page's intervals, from the oldest
+                          to the newest
+        @type intervals: list
+        '''
+
+        for interval in intervals:
+            if pageid == self.last_pageid and interval.rank == self.last_rank:
+                continue
+            self.write((pageid, interval.start_timestamp, interval.rank))
+
+    def close(self):
+        self.outfile.write(self.codes)
+        self.outfile.seek(0)
+        self.outfile.write(HEADER.pack(MAGIC, self.n_records,
+                                       len(self.classes)))
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _KeyColumn:
+    '''
+    Sequence view of the key column, used for bisection.
+    '''
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<Q', self.buf, self.offset + 8*i)[0]
+
+class TimeIndex:
+    def __init__(self, filename):
+        '''
+        Open and memory-map the given index file.
+
+        @param filename: path to the index file
+        @type filename: str
+        '''
+
+        with open(os.path.expanduser(filename), 'rb') as infile:
+            self.buf = mmap.mmap(infile.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        (magic, self.n_records, n_classes) = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a time index'.format(filename))
+
+        offset = HEADER.size
+        self.classes = []
+        for i in range(n_classes):
+            length = struct.unpack_from('<B', self.buf, offset)[0]
+            offset += 1
+            self.classes.append(self.buf[offset:offset+length].decode('utf-8'))
+            offset += length
+        offset += -offset % 8
+
+        self.key_offset = offset
+        self.class_offset = offset + 8*self.n_records
+        self.keys = _KeyColumn(self.buf, self.key_offset, self.n_records)
+
+    def __len__(self):
+        return self.n_records
+
+    def _classname(self, code):
+        if code == UNASSESSED:
+            return None
+        return self.classes[code]
+
+    def lookup(self, pageid, timestamp):
+        '''
+        Get the assessment class the given page had at the given time,
+        or None if it had none.
+
+        @param pageid: page ID of the article
+        @type pageid: int
+
+        @param timestamp: MediaWiki timestamp
+        @type timestamp: str or int
+        '''
+
+        i = bisect.bisect_right(self.keys, make_key(pageid, timestamp)) - 1
+        if i < 0 or self.keys[i] >> 32 != pageid:
+            return None
+        return self._classname(ord(self.buf[self.class_offset + i:
+                                            self.class_offset + i + 1]))
+
+    def lookup_many(self, pageids, timestamps):
+        '''
+        Get the assessment classes many pages had at the given times.
+        Returns a list in the same order as the given page IDs, with None
+        where a page had no class.
+
+        @param pageids: page IDs of the articles
+        @type pageids: list
+
+        @param timestamps: MediaWiki timestamps, one per page ID
+        @type timestamps: list
+        '''
+
+        if numpy is None:
+            return [self.lookup(pageid, timestamp)
+                    for (pageid, timestamp) in zip(pageids, timestamps)]
+
+        result = [None] * len(pageids)
+        if not self.n_records:
+            return result
+
+        column = numpy.frombuffer(self.buf, dtype='<u8',
+                                  count=self.n_records,
+                                  offset=self.key_offset)
+        codes = numpy.frombuffer(self.buf, dtype='u1',
+                                 count=self.n_records,
+                                 offset=self.class_offset)
+
+        pages = numpy.asarray(pageids, dtype='<u8')
+        seconds = numpy.fromiter((to_seconds(timestamp)
+                                  for timestamp in timestamps),
+                                 dtype='<u8', count=len(pages))
+        queries = (pages << numpy.uint64(32)) | seconds
+
+        positions = numpy.searchsorted(column, queries, side='right') - 1
+        found = positions >= 0
+        positions = numpy.maximum(positions, 0)
+        found &= (column[positions] >> numpy.uint64(32)) == pages
+
+        for (i, code) in zip(numpy.flatnonzero(found),
+                             codes[positions[found]]):
+            result[i] = self._classname(code)
+        return result
+
+    def close(self):
+        self.buf.close()
@@ -0,0 +1,148 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Assessment timelines of talk pages.
+
+A timeline splits a talk page's history into intervals during which
+its assessments stayed the same.  Each interval has the first and last
+revision it covers, the highest class on the WP 1.0 scale, and the
+rating each project gave.  A new interval starts whenever any project's
+rating changes, so every class transition is where an interval starts,
+but not every interval starts a new class.
+
+TimelineBuilder takes the revisions one at a time, in either direction,
+so the history only has to be walked once, and a caller that only needs
+the latest intervals can stop early.  It can also continue a timeline
+built earlier, see timelinecache.py.  Like clean_article() always did,
+revisions without content are skipped, and so are revisions without
+valid assessments that were reverted, which are usually vandalism.
+'''
+
+class Interval(object):
+    __slots__ = ('start_rev', 'start_timestamp', 'end_rev', 'end_timestamp',
+                 'rank', 'ratings')
+
+    def __init__(self, start_rev, start_timestamp, end_rev, end_timestamp,
+                 rank, ratings):
+        self.start_rev = start_rev
+        self.start_timestamp = start_timestamp
+        self.end_rev = end_rev
+        self.end_timestamp = end_timestamp
+
+        # Highest rank on the WP 1.0 scale, None if unassessed
+        self.rank = rank
+
+        # Sorted (project, rating) pairs
+        self.ratings = ratings
+
+    def __repr__(self):
+        return 'Interval({0}, {1}, {2}, {3}, {4!r}, {5!r})'.format(
+            self.start_rev, self.start_timestamp,
+            self.end_rev, self.end_timestamp, self.rank, self.ratings)
+
+class TimelineBuilder:
+    def __init__(self, newest_first=False, is_reverted=None, intervals=None):
+        '''
+        Start a timeline, empty or continuing from the given intervals.
+
+        @param newest_first: are revisions added from the newest to the
+                             oldest, rather than in the order they were made?
+        @type newest_first: bool
+
+        @param is_reverted: function taking a revision ID that tells if the
+                            revision was reverted, asked about revisions
+                            without valid assessments; if None they are
+                            all kept
+        @type is_reverted: function
+
+        @param intervals: intervals of an earlier timeline of the page
+                          to continue, in the order revisions are added
+        @type intervals: list
+        '''
+
+        self.newest_first = newest_first
+        self.is_reverted = is_reverted
+
+        # Closed intervals in the order they were built, and the one
+        # the last revision added belongs to
+        self.intervals = []
+        self.current = None
+        if intervals:
+            self.intervals = list(intervals[:-1])
+            self.current = intervals[-1]
+
+    def add(self, revision, assessments):
+        '''
+        Add the next revision of the talk page.  Returns the interval
+        it closed, if any.
+
+        @param revision: the revision, with id and timestamp
+        @type revision: TPRevision
+
+        @param assessments: the assessments in the revision,
+                            None if it has no content
+        @type assessments: list
+        '''
+
+        if assessments is None:
+            return None
+
+        ranks = [assessment.rank for assessment in assessments
+                 if assessment.rank is not None]
+        rank = None
+        if ranks:
+            rank = max(ranks)
+        elif self.is_reverted and self.is_reverted(revision.id):
+            return None
+
+        ratings = tuple(sorted(set((assessment.project, assessment.rating)
+                                   for assessment in assessments)))
+
+        current = self.current
+        if current and current.ratings == ratings:
+            if self.newest_first:
+                current.start_rev = revision.id
+                current.start_timestamp = revision.timestamp
+            else:
+                current.end_rev = revision.id
+                current.end_timestamp = revision.timestamp
+            return None
+
+        if current:
+            self.intervals.append(current)
+        self.current = Interval(revision.id, revision.timestamp,
+                                revision.id, revision.timestamp,
+                                rank, ratings)
+        return current
+
+    def timeline(self):
+        '''
+        Get the intervals built so far, including the open one,
+        from the oldest to the newest.
+        '''
+
+        intervals = list(self.intervals)
+        if self.current:
+            intervals.append(self.current)
+        if self.newest_first:
+            intervals.reverse()
+        return intervals
+
+    def transitions(self):
+        '''
+        Get the intervals between changes of the highest class, from
+        the oldest to the newest.  The ratings of each are those at
+        its end.
+        '''
+
+        merged = []
+        for interval in self.timeline():
+            if merged and merged[-1].rank == interval.rank:
+                merged[-1] = Interval(merged[-1].start_rev,
+                                      merged[-1].start_timestamp,
+                                      interval.end_rev,
+                                      interval.end_timestamp,
+                                      interval.rank, interval.ratings)
+            else:
+                merged.append(interval)
+        return merged
@@ -0,0 +1,178 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Disk cache of talk page assessment timelines.
+
+For every talk page we have cleaned, we store the timeline built while
+walking its history (see timeline.py) together with a high-water mark,
+the newest talk page revision we have looked at.  When the page is
+cleaned again, only revisions newer than the mark are fetched and
+assessed, continuing the stored timeline.
+
+A timeline is complete if the walk reached the page's first revision.
+Otherwise it was stopped at the first interval with a different class
+than the one we were looking for, and its oldest interval is cut short.
+If a later run needs to look further back than that, the page has to be
+walked again in full.
+
+Whether a revision without assessments was reverted is decided when it
+is first assessed, so a revert made after a run will not be noticed.
+
+The cached timelines can be exported as a class lookup index of the
+articles, see export_index() and timeindex.py.
+'''
+
+import os
+import json
+import logging
+
+from timeline import Interval
+from timeindex import TimeIndexWriter
+
+class TimelineCache:
+    def __init__(self, filename):
+        '''
+        Instantiate the cache, reading it from disk if it exists.
+
+        @param filename: path to the cache file
+        @type filename: str
+        '''
+
+        self.filename = os.path.expanduser(filename)
+
+        # Maps talk page ID (as str) to a dict with the page ID of its
+        # article ('pageid'), the revision ID and
+        # timestamp of the high-water mark ('mark', 'mark_timestamp'),
+        # whether the timeline is complete ('complete'), and its intervals
+        # from the oldest to the newest ('intervals'), each a list of
+        # start revision, start timestamp, end revision, end timestamp,
+        # rank, and (project, rating) pairs
+        self.pages = {}
+
+        self.load()
+
+    def load(self):
+        '''
+        Read the cache from disk, if it exists.
+        '''
+
+        if not os.path.exists(self.filename):
+            logging.info('no timeline cache found at {0}'.format(self.filename))
+            return
+
+        try:
+            with open(self.filename, 'r') as infile:
+                self.pages = json.load(infile)
+        except (IOError, ValueError) as e:
+            logging.warning('unable to read timeline cache {0}: {1}'.format(self.filename, e))
+            self.pages = {}
+            return
+
+        logging.info('read cached timelines for {0} talk pages from {1}'.format(len(self.pages), self.filename))
+
+    def save(self):
+        '''
+        Write the cache to disk.
+        '''
+
+        tmp_filename = '{0}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as outfile:
+            json.dump(self.pages, outfile)
+        os.rename(tmp_filename, self.filename)
+
+        logging.info('wrote timeline cache to {0}'.format(self.filename))
+
+    def get(self, talkpageid):
+        '''
+        Get the cached state of the given talk page, or None if it is not
+        cached.  Returns a tuple of the high-water mark's revision ID and
+        timestamp, whether the timeline is complete, and its intervals.
+
+        @param talkpageid: page ID of the talk page
+        @type talkpageid: int
+        '''
+
+        state = self.pages.get(str(talkpageid))
+        if state is None:
+            return None
+
+        intervals = [Interval(start_rev, str(start_timestamp),
+                              end_rev, str(end_timestamp), rank,
+                              tuple((project, rating)
+                                    for (project, rating) in ratings))
+                     for (start_rev, start_timestamp, end_rev, end_timestamp,
+                          rank, ratings) in state['intervals']]
+        return (state['mark'], str(state['mark_timestamp']),
+                state['complete'], intervals)
+
+    def put(self, talkpageid, mark, mark_timestamp, complete, intervals,
+            pageid=None):
+        '''
+        Store the state of the given talk page.
+
+        @param talkpageid: page ID of the talk page
+        @type talkpageid: int
+
+        @param mark: revision ID of the newest revision looked at
+        @type mark: int
+
+        @param mark_timestamp: timestamp of that revision
+        @type mark_timestamp: str
+
+        @param complete: does the timeline go back to the first revision?
+        @type complete: bool
+
+        @param intervals: the timeline, from the oldest to the newest interval
+        @type intervals: list
+
+        @param pageid: page ID of the article, needed to export the
+                       timeline to a class lookup index
+        @type pageid: int
+        '''
+
+        self.pages[str(talkpageid)] = {
+            'pageid': pageid,
+            'mark': mark,
+            'mark_timestamp': mark_timestamp,
+            'complete': complete,
+            'intervals': [[interval.start_rev, interval.start_timestamp,
+                           interval.end_rev, interval.end_timestamp,
+                           interval.rank, interval.ratings]
+                          for interval in intervals]}
+
+    def export_index(self, filename, classes=None):
+        '''
+        Write the cached timelines to a class lookup index keyed by
+        article page ID, see timeindex.py.  Timelines stored without
+        their article's page ID are left out.
+
+        @param filename: path to the index file
+        @type filename: str
+
+        @param classes: assessment class names, ordered by rank,
+                        by default the WP 1.0 scale
+        @type classes: list
+        '''
+
+        timelines = []
+        n_partial = 0
+        n_skipped = 0
+        for (talkpageid, state) in self.pages.items():
+            if state.get('pageid') is None:
+                n_skipped += 1
+                continue
+            if not state['complete']:
+                n_partial += 1
+            timelines.append((int(state['pageid']), talkpageid))
+        timelines.sort()
+
+        with TimeIndexWriter(filename, classes) as writer:
+            for (pageid, talkpageid) in timelines:
+                (mark, mark_timestamp, complete, intervals) = self.get(talkpageid)
+                writer.write_timeline(pageid, intervals)
+
+        logging.info('wrote timelines of {n} articles to {0}'.format(filename, n=len(timelines)))
+        if n_partial:
+            logging.warning('{n} of the timelines written do not go back to the first revision of their talk page, lookups before their oldest interval give no class'.format(n=n_partial))
+        if n_skipped:
+            logging.warning('left out {n} timelines cached without the page ID of their article'.format(n=n_skipped))
@@ -0,0 +1,190 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Stage timers for finding out where the time goes when processing
+articles.
+
+StageTimer accumulates wall time and call counts per named stage, both
+per article and for the whole run, and prints a summary or writes it
+as JSON.  NullTimer has the same interface and does nothing, so timing
+costs next to nothing when it is switched off.
+'''
+
+import json
+import time
+
+class _Stage:
+    '''
+    Context manager timing a single stage.
+    '''
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+class _Article:
+    '''
+    Context manager collecting the stages of a single article.
+    '''
+
+    def __init__(self, timer, articleid):
+        self.timer = timer
+        self.articleid = articleid
+
+    def __enter__(self):
+        self.timer.current = {}
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.articles.append({'article': self.articleid,
+                                    'seconds': time.time() - self.start,
+                                    'stages': self.timer.current})
+        self.timer.current = None
+        return False
+
+class StageTimer:
+    def __init__(self):
+        # Maps stage name to [total seconds, number of calls]
+        self.totals = {}
+
+        # Per-article timings, and the stages of the current article
+        self.articles = []
+        self.current = None
+
+        self.start = time.time()
+
+    def stage(self, name):
+        '''
+        Time a stage, use as "with timer.stage('name'):".
+
+        @param name: name of the stage
+        @type name: str
+        '''
+        return _Stage(self, name)
+
+    def article(self, articleid):
+        '''
+        Collect the stages of an article, use as
+        "with timer.article(pageid):".
+
+        @param articleid: identifier of the article, e.g. its page ID
+        @type articleid: str
+        '''
+        return _Article(self, articleid)
+
+    def add(self, name, seconds):
+        '''
+        Add the time spent in a stage.
+
+        @param name: name of the stage
+        @type name: str
+
+        @param seconds: time spent
+        @type seconds: float
+        '''
+
+        total = self.totals.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+        if self.current is not None:
+            total = self.current.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def summary(self):
+        '''
+        Get a summary of the run as a dict.
+        '''
+
+        elapsed = time.time() - self.start
+        stages = {}
+        for (name, (seconds, count)) in self.totals.items():
+            stages[name] = {'seconds': seconds,
+                            'count': count,
+                            'mean': seconds / count,
+                            'share': seconds / elapsed if elapsed else 0.0}
+
+        article_times = sorted(article['seconds'] for article in self.articles)
+        n = len(article_times)
+        articles = {'count': n}
+        if n:
+            articles.update({'median': article_times[n//2],
+                             'p95': article_times[min(n-1, int(n*0.95))],
+                             'max': article_times[-1]})
+
+        return {'seconds': elapsed,
+                'stages': stages,
+                'articles': articles}
+
+    def report(self, slowest=10):
+        '''
+        Get a printable summary of the run.
+
+        @param slowest: number of slowest articles to list
+        @type slowest: int
+        '''
+
+        summary = self.summary()
+        lines = [u'Processed {n} articles in {s:.1f}s'.format(
+            n=summary['articles']['count'], s=summary['seconds'])]
+        if summary['articles']['count']:
+            lines.append(u'Per article: median {median:.3f}s, 95th percentile {p95:.3f}s, max {max:.3f}s'.format(**summary['articles']))
+
+        lines.append(u'{0:<20} {1:>10} {2:>8} {3:>10} {4:>6}'.format(
+            'stage', 'seconds', 'calls', 'mean', 'share'))
+        for (name, stage) in sorted(summary['stages'].items(),
+                                    key=lambda item: -item[1]['seconds']):
+            lines.append(u'{0:<20} {seconds:>10.2f} {count:>8} {mean:>10.4f} {share:>6.1%}'.format(name, **stage))
+
+        if self.articles:
+            lines.append(u'Slowest articles:')
+            for article in sorted(self.articles,
+                                  key=lambda article: -article['seconds'])[:slowest]:
+                lines.append(u'  {article}: {seconds:.3f}s'.format(**article))
+
+        return u'\n'.join(lines)
+
+    def write_json(self, filename):
+        '''
+        Write the summary and per-article timings as JSON.
+
+        @param filename: path to the output file
+        @type filename: str
+        '''
+
+        with open(filename, 'w') as outfile:
+            json.dump({'summary': self.summary(),
+                       'articles': self.articles}, outfile, indent=2)
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class NullTimer:
+    '''
+    Timer that does nothing, used when timing is switched off.
+    '''
+
+    context = _NullContext()
+
+    def stage(self, name):
+        return self.context
+
+    def article(self, articleid):
+        return self.context
+
+    def add(self, name, seconds):
+        pass
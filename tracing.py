@@ -0,0 +1,264 @@
+#!/usr/env/python
+# -*- coding: utf-8 -*-
+'''
+Trace files in Chrome's trace-event format.
+
+The Tracer records a span for every database query and API request made
+through its wrapped cursor and site, plus any spans the scripts mark
+themselves (traversal slices, articles), together with the process and
+thread they ran in.  The resulting JSON file can be loaded in
+chrome://tracing or Perfetto to see serialisation, idle gaps and
+long-tail articles.
+
+NullTracer has the same interface and records nothing.
+'''
+
+import os
+import json
+import time
+import threading
+
+class _Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add(self.name, self.category, self.start,
+                        time.time(), self.args)
+        return False
+
+class TracingCursor:
+    '''
+    Wraps a database cursor, tracing every query.
+
+    Like db.SlowQueryCursor, a query's span includes reading its result,
+    which for the unbuffered cursors we use is where most of the time
+    goes, so it ends when the rows are used up, the next query is made,
+    or the cursor is closed.  The time spent in the cursor itself,
+    rather than in the caller between fetches, is given as "db_seconds".
+    '''
+
+    def __init__(self, cursor, tracer):
+        self.cursor = cursor
+        self.tracer = tracer
+
+        # Span of the current query, and its rows read so far
+        self.span = None
+        self.seconds = 0.0
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            result = func(*args)
+        except Exception, e:
+            self.seconds += time.time() - start
+            if self.span is not None:
+                self.span.args['error'] = e.__class__.__name__
+            self._finish()
+            raise
+        self.seconds += time.time() - start
+        return result
+
+    def _finish(self):
+        if self.span is not None:
+            self.tracer.end(self.span, rows=self.rows,
+                            db_seconds=round(self.seconds, 6))
+        self.span = None
+
+    def execute(self, query, params=None):
+        self._finish()
+        args = {'query': u' '.join(query.split())[:500]}
+        if params:
+            args['params'] = repr(params)
+        self.span = self.tracer.begin('query', 'db', **args)
+        self.seconds = 0.0
+        self.rows = 0
+        if params is None:
+            return self._timed(self.cursor.execute, query)
+        return self._timed(self.cursor.execute, query, params)
+
+    def fetchone(self):
+        row = self._timed(self.cursor.fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchall(self):
+        rows = self._timed(self.cursor.fetchall)
+        self.rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        self._finish()
+        self.cursor.close()
+
+class TracingSite:
+    '''
+    Wraps a pywikibot site (or a recording or replaying site),
+    tracing every API request made through revisions.api_request().
+    '''
+
+    def __init__(self, site, tracer):
+        self.site = site
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.site, name)
+
+    def api_request(self, params):
+        args = dict((key, unicode(value)[:200])
+                    for (key, value) in params.items())
+        import revisions
+        with self.tracer.span('api_request', 'api', **args):
+            return revisions.api_request(self.site, params)
+
+class Tracer:
+    def __init__(self, filename):
+        '''
+        Start tracing, the trace is written to the given file on save().
+
+        @param filename: path to the trace file
+        @type filename: str
+        '''
+
+        self.filename = filename
+        self.pid = os.getpid()
+        self.start = time.time()
+        self.events = []
+        self.threads = {}
+
+    def add(self, name, category, start, end, args=None):
+        '''
+        Add a completed span.
+
+        @param name: name of the span
+        @type name: str
+
+        @param category: category of the span, e.g. "db" or "api"
+        @type category: str
+
+        @param start: start time, as from time.time()
+        @type start: float
+
+        @param end: end time, as from time.time()
+        @type end: float
+
+        @param args: extra information shown with the span
+        @type args: dict
+        '''
+
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        self.events.append({'name': name,
+                            'cat': category,
+                            'ph': 'X',
+                            'ts': (start - self.start) * 1e6,
+                            'dur': (end - start) * 1e6,
+                            'pid': self.pid,
+                            'tid': thread.ident,
+                            'args': args or {}})
+
+    def span(self, name, category, **args):
+        '''
+        Trace a span, use as "with tracer.span('name', 'category'):".
+        '''
+        return _Span(self, name, category, args)
+
+    def begin(self, name, category, **args):
+        '''
+        Start a span that is ended with end(), for code where a
+        with-block does not fit.
+        '''
+        span = _Span(self, name, category, args)
+        span.__enter__()
+        return span
+
+    def end(self, span, **args):
+        '''
+        End a span started with begin(), adding any extra information.
+        '''
+        span.args.update(args)
+        span.__exit__(None, None, None)
+
+    def wrap_cursor(self, cursor):
+        if cursor is None:
+            return None
+        return TracingCursor(cursor, self)
+
+    def wrap_site(self, site):
+        return TracingSite(site, self)
+
+    def save(self):
+        '''
+        Write the trace file.
+        '''
+
+        events = list(self.events)
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                       'args': {'name': os.path.basename(
+                           os.path.abspath(os.sys.argv[0]))}})
+        for (tid, name) in self.threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': self.pid, 'tid': tid,
+                           'args': {'name': name}})
+
+        with open(self.filename, 'w') as outfile:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms'}, outfile)
+
+class _NullSpan:
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class NullTracer:
+    '''
+    Tracer that records nothing, used when tracing is switched off.
+    '''
+
+    null_span = _NullSpan()
+
+    def span(self, name, category, **args):
+        return self.null_span
+
+    def begin(self, name, category, **args):
+        return self.null_span
+
+    def end(self, span, **args):
+        pass
+
+    def wrap_cursor(self, cursor):
+        return cursor
+
+    def wrap_site(self, site):
+        return site
+
+    def save(self):
+        pass